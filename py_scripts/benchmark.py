@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times the hot paths, so we have numbers to go on when picking Slurm array
+sizes and `--cpus-per-task`, and so a slow-down between revisions shows up.
+
+    python benchmark.py [OUTPUT]
+    python benchmark.py compare OLD NEW
+
+Everything runs on synthetic subjects made with `simulate` (seeded, so every
+run benchmarks the same trials), at each of `TRIAL_COUNTS` and each parameter
+setting in `SETTINGS`:
+
+    - objective: one likelihood, via `mle`, `neg_log_posterior` (with and
+    without the gradient), and `batch_neg_log_posterior` (per row of a batch
+    of `BATCH_SIZE` parameter vectors)
+    - fit: one full `wrapper.model` fit from a fixed start
+    - simulate: `simulate` (one agent) and `simulate_many` (`BATCH_SIZE`
+    agents), as trials per second
+    - splice: `splice_raw` on a synthetic `Raw_Data.csv` of `SPLICE_SUBJECTS`
+    subjects, in a temporary folder
+    - startup: a fresh python process, from launch to its first objective
+    evaluation, going through the same imports and trial store as a
+    `run_wrapper.py` job. It should stay under `STARTUP_BUDGET` seconds, and
+    none of `HEAVY_MODULES` should have been imported by then
+
+Each timing is the median (and the fastest) of several repeats, per call.
+Peak memory gets measured separately, with `tracemalloc` on for one more call,
+since tracing slows everything down. Results go to OUTPUT (by default
+`benchmarks/<time>-<revision>.json` in the repo), along with the revision and
+package versions, and `compare` prints how each timing changed between two of
+those files.
+"""
+
+from sys import argv, executable
+from os import path, makedirs, cpu_count
+from tempfile import TemporaryDirectory
+from time import perf_counter, strftime
+import json
+import platform
+import random
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+from simulate_and_model import mle
+from wrapper import PARAM_NAMES, extract_key_variables, simulate, model, load_trials
+from likelihood import neg_log_posterior, batch_neg_log_posterior
+from bulk_simulate import simulate_many
+from trial_store import build_trial_store
+from prep_params_for_cluster import splice_raw
+
+
+TRIAL_COUNTS = (100, 250, 500)
+SETTINGS = {
+    "typical": (.5, 3, .6, .3, -.2, .7, .4, .3, .2),
+    "greedy": (.9, 10, .2, 1, .5, .5, .5, .5, .5)
+}
+BOUNDS = ((.0001, .9999), (.0001, 20), (.0001, .9999), (-20, 20), (-20, 20),
+          (.0001, .9999), (.0001, .9999), (.0001, .9999), (.0001, .9999))
+START = (.5, 1, .5, 0, 0, .5, .5, .5, .5)
+BATCH_SIZE = 100
+SPLICE_SUBJECTS = 100
+STARTUP_BUDGET = .5                                                             # seconds, from launching a job to its first objective evaluation
+HEAVY_MODULES = ("pandas", "scipy.stats", "pyarrow", "siuba")                  # none of which a job should need before it starts fitting
+
+# what a `run_wrapper.py` job does before its first objective evaluation,
+# except that the trials come from a temporary trial store; scipy.optimize
+# gets imported since the fit would import it first thing
+STARTUP_SCRIPT = """
+import sys, json
+sys.path.insert(0, {scripts_dir!r})
+import run_wrapper
+from wrapper import load_trials
+from likelihood import neg_log_posterior
+import scipy.optimize
+trials = load_trials(data_directory={data_directory!r}, sub_path="synthetic.csv")
+neg_log_posterior(list({start!r}), trials, True, True)
+print(json.dumps([name for name in {heavy!r} if name in sys.modules]))
+"""
+
+_repo_dir = path.join(path.dirname(path.abspath(__file__)), "..")
+
+
+def synthetic_subject(params, trials, seed=0, miss_rate=.05):
+
+    # a subject's spliced trials, in the same format `splice_raw` writes, with
+    # a few trials left unfinished
+    random.seed(seed)
+    np.random.seed(seed)
+    log = simulate(**dict(zip(PARAM_NAMES, params)), trials=trials)
+
+    missed = np.random.default_rng(seed).uniform(size=len(log)) < miss_rate
+    return pd.DataFrame({
+        "trial_index": log.trial_index,
+        "og_pair": log.og_pair,
+        "stake_type": log.stake_type,
+        "pair_sides": log.pair_sides,
+        "preset_planet": np.where(missed, "NA", log.planet),
+        "completed_trial": (~missed).astype(int),
+        "points": np.where(missed, np.nan, log.points)
+    })
+
+
+def synthetic_raw(n_subjects, trials=300, seed=0):
+
+    # the other way around from `splice_raw`: spliced trials back into the
+    # columns of `Raw_Data.csv` (for "second_go", where 3 is the neutral stake)
+    stakes = {"high": 5, "faux_high": 3, "faux_low": 3, "low": 1}
+    subjects = []
+
+    for subject in range(n_subjects):
+        sub_df = synthetic_subject(SETTINGS["typical"], trials, seed + subject)
+        first_pair = sub_df.og_pair == "one"
+        subjects.append(pd.DataFrame({
+            "assignment_id": "sub" + str(subject),
+            "trial_index": sub_df.trial_index,
+            "practice": 0,
+            "state1": np.where(first_pair, 1, 2),
+            "stim_left": np.where(first_pair, 1, 3) + (sub_df.pair_sides == "b"),
+            "state2": sub_df.preset_planet.map({"red": 1, "purple": 2}).fillna(-1).astype(int),
+            "stake": sub_df.stake_type.map(stakes),
+            "points": sub_df.points.fillna(0),
+            "rt_2": np.where(sub_df.completed_trial == 1, 500, -1)
+        }))
+
+    return pd.concat(subjects, ignore_index=True)
+
+
+def timed(func, repeats=5, min_time=.1):
+
+    # seconds per call for each repeat, with enough calls per repeat to take
+    # at least `min_time`
+    start = perf_counter()
+    func()
+    number = max(1, int(min_time / max(perf_counter() - start, 1e-9)))
+
+    per_call = []
+    for _ in range(repeats):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        per_call.append((perf_counter() - start) / number)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"median_s": float(np.median(per_call)), "min_s": min(per_call), "calls": number * repeats,
+            "peak_bytes": peak}
+
+
+def objective_benchmarks(sub_df, params):
+    trials = load_trials(data_directory=None, sub_path=sub_df)
+    param_sets = np.random.default_rng(0).uniform(*np.array(BOUNDS).T, (BATCH_SIZE, len(PARAM_NAMES)))
+    param_sets[:, 3:5] /= 10                                                    # keeps π and ρ where the softmax doesn't overflow
+
+    batch = timed(lambda: batch_neg_log_posterior(param_sets, trials, True, True))
+    batch.update(median_s=batch["median_s"] / BATCH_SIZE, min_s=batch["min_s"] / BATCH_SIZE)   # per parameter vector
+
+    return {
+        "mle": timed(lambda: mle(np.array(params), ["one", "two"], ["red", "purple"], sub_df, True), repeats=3),
+        "neg_log_posterior": timed(lambda: neg_log_posterior(params, trials, True)),
+        "neg_log_posterior_gradient": timed(lambda: neg_log_posterior(params, trials, True, True)),
+        "batch_neg_log_posterior_per_row": batch
+    }
+
+
+def fit_benchmark(sub_df):
+    kwargs = {"include_priors": True}
+    for param, (lb, ub), x0 in zip(PARAM_NAMES, BOUNDS, START):
+        kwargs.update({param + "_0": x0, param + "_lb": lb, param + "_ub": ub})
+
+    fits = []
+    result = timed(lambda: fits.append(model(data_directory=None, sub_path=sub_df, **kwargs)), repeats=3, min_time=0)
+    result.update(nfev=int(fits[-1][1].nfev), nit=int(fits[-1][1].nit))
+
+    return result
+
+
+def simulate_benchmarks(params, trials):
+    param_sets = np.tile(params, (BATCH_SIZE, 1))
+
+    one = timed(lambda: simulate(**dict(zip(PARAM_NAMES, params)), trials=trials), repeats=3)
+    many = timed(lambda: simulate_many(param_sets=param_sets, trials=trials, seed=0), repeats=3)
+
+    one["trials_per_s"] = trials / one["median_s"]
+    many["trials_per_s"] = trials * BATCH_SIZE / many["median_s"]
+
+    return {"simulate": one, "simulate_many": many}
+
+
+def splice_benchmark():
+    with TemporaryDirectory() as data_directory:
+        makedirs(path.join(data_directory, "Spliced"))
+        synthetic_raw(SPLICE_SUBJECTS).to_csv(path.join(data_directory, "Raw_Data.csv"), index=False)
+
+        result = timed(lambda: splice_raw(data_directory=data_directory, experiment="second_go"), repeats=3, min_time=0)
+
+    result["subjects"] = SPLICE_SUBJECTS
+    return result
+
+
+@extract_key_variables
+def startup_benchmark(rocket_pairs, pair_sides, planets, sub_df, repeats=5):
+    with TemporaryDirectory() as data_directory:
+        build_trial_store(rocket_pairs, pair_sides, planets, data_directory, {"synthetic.csv": sub_df})
+        script = STARTUP_SCRIPT.format(scripts_dir=path.dirname(path.abspath(__file__)), data_directory=data_directory,
+                                       start=START, heavy=HEAVY_MODULES)
+
+        per_launch = []
+        for _ in range(repeats):
+            start = perf_counter()
+            heavy = json.loads(subprocess.run([executable, "-c", script], capture_output=True, text=True,
+                                              check=True).stdout)
+            per_launch.append(perf_counter() - start)
+
+    median = float(np.median(per_launch))
+    return {"median_s": median, "min_s": min(per_launch), "calls": repeats, "budget_s": STARTUP_BUDGET,
+            "within_budget": median <= STARTUP_BUDGET, "heavy_modules": heavy}
+
+
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_repo_dir,
+                                  capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = ""
+
+    return {"revision": revision or "unknown", "time": strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "scipy": scipy.__version__, "machine": platform.machine(), "cpus": cpu_count()}
+
+
+def run_benchmarks():
+    results = {"environment": environment(), "benchmarks": {}}
+
+    for setting, params in SETTINGS.items():
+        for trials in TRIAL_COUNTS:
+            sub_df = synthetic_subject(params, trials)
+            name = f"{setting}/{trials}"
+            print(name)
+
+            results["benchmarks"][name] = {**objective_benchmarks(sub_df, params),
+                                           "fit": fit_benchmark(sub_df),
+                                           **simulate_benchmarks(params, trials)}
+
+    print("splice_raw")
+    results["benchmarks"]["splice_raw"] = {"splice_raw": splice_benchmark()}
+
+    print("startup")
+    startup = startup_benchmark(sub_df=synthetic_subject(SETTINGS["typical"], max(TRIAL_COUNTS)))
+    results["benchmarks"]["startup"] = {"startup": startup}
+    if not startup["within_budget"] or startup["heavy_modules"]:
+        print(f"startup took {startup['median_s']:.2f}s (budget {STARTUP_BUDGET}s), "
+              f"with {', '.join(startup['heavy_modules']) or 'nothing heavy'} imported")
+
+    return results
+
+
+def compare(old, new):
+    for name, benchmarks in new["benchmarks"].items():
+        for benchmark, result in benchmarks.items():
+            before = old["benchmarks"].get(name, {}).get(benchmark)
+            if before is None:
+                continue
+            print(f"{name:>16} {benchmark:<32} {before['median_s']:10.3g}s -> {result['median_s']:10.3g}s "
+                  f"({result['median_s'] / before['median_s']:.2f}x)")
+
+
+if __name__ == '__main__':
+
+    if len(argv) > 1 and argv[1] == "compare":
+        with open(argv[2]) as old, open(argv[3]) as new:
+            compare(json.load(old), json.load(new))
+
+    else:
+        results = run_benchmarks()
+
+        if len(argv) > 1:
+            output = argv[1]
+        else:
+            output = path.join(_repo_dir, "benchmarks",
+                               f"{results['environment']['time'].replace(':', '')}-{results['environment']['revision']}.json")
+            makedirs(path.dirname(output), exist_ok=True)
+
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(output)
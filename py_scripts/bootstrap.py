@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parametric bootstrap and posterior predictive checks of each subject's best
+fit: simulates lots of datasets from the fitted parameters, refits each one,
+and compares the simulated behaviour to the subject's.
+
+    python bootstrap.py [REPLICATES [PROCESSES [SEED]]]
+
+Takes the best fit for each subject (see `best_fits` in `results_store.py`)
+and splits each subject's REPLICATES (100 by default) into chunks of
+`REPLICATES_PER_TASK`, which get spread across a process pool. A worker
+simulates its whole chunk at once with `simulate_many`, with as many trials as
+the subject completed, then refits every simulated dataset (with the same
+bounds and priors setting as the subject's own fit) from `REFIT_STARTS`
+random starts within the bounds, keeping the best, and hands back only the
+summaries: each dataset's stay probabilities and its refit parameters.
+Starting from the generating parameters instead would flatter the recovery,
+since the optimizer would begin right at the answer. Back in the main process, those get
+folded into running totals as each chunk finishes, so the simulated trials
+never pile up in memory.
+
+A stay is picking the same planet as on the trial before, split by whether
+that trial's points were a loss (0 or less) or a gain and by this trial's
+stake type. For real subjects, "the trial before" is the last completed one.
+
+Writes three csvs to `bootstrap` in the experiment's folder:
+`stay_probabilities.csv` (the subject's stay probability in each cell, the
+mean and SD across the simulated datasets, and the share of those at or above
+the subject's), `parameters.csv` (each fitted parameter, with the mean and SD
+of its refits, i.e., bootstrap standard errors), and `recovery.csv` (the
+correlation across subjects between the generating and the refit value of
+each parameter).
+"""
+
+from sys import argv
+from os import path, makedirs
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from simulate_and_model import STAKE_TYPES
+from wrapper import PARAM_NAMES, fit_trials, load_trials
+from bulk_simulate import simulate_many
+
+
+REPLICATES_PER_TASK = 10
+REFIT_STARTS = 3                                                                # random starts per simulated dataset
+REWARDS = ("loss", "gain")                                                      # the previous trial's points: 0 or less, or more than 0
+
+
+def stay_counts(trials):
+
+    # stays and chances to stay, as (rewards x stake types) arrays
+    stay = trials.planet[1:] == trials.planet[:-1]
+    cells = (trials.payoff[:-1] > 0) * len(STAKE_TYPES) + trials.stake[1:]
+    size = len(REWARDS) * len(STAKE_TYPES)
+
+    stays = np.bincount(cells, weights=stay, minlength=size).reshape(len(REWARDS), len(STAKE_TYPES))
+    chances = np.bincount(cells, minlength=size).reshape(len(REWARDS), len(STAKE_TYPES))
+    return stays, chances
+
+
+def stay_probabilities(trials):
+    stays, chances = stay_counts(trials)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return stays / chances                                                  # NaN for cells that never came up
+
+
+def replicate_chunk(key, x, bounds, include_priors, n_trials, replicates, seed):
+
+    # one process's share of a subject's datasets: simulate them, then refit
+    # each from its own random starts, and only send back what gets aggregated
+    simulated = simulate_many(param_sets=np.tile(x, (replicates, 1)), trials=n_trials, seed=seed)
+    simulated = simulated.rename(columns={"planet": "preset_planet"}).assign(completed_trial=True)
+
+    lb, ub = np.array(bounds, dtype=float).T
+    starts = np.random.default_rng(seed + [1]).uniform(lb, ub, (replicates, REFIT_STARTS, len(x)))   # a stream of its own, apart from the simulation's
+
+    stays, refits = [], []
+    for (_, agent_df), agent_starts in zip(simulated.groupby("agent"), starts):
+        trials = load_trials(data_directory=None, sub_path=agent_df)
+        stays.append(stay_probabilities(trials))
+        fits = [fit_trials(trials, x0, bounds, include_priors) for x0 in agent_starts]
+        refits.append(min(fits, key=lambda fit: fit.fun).x)
+
+    return key, np.array(stays), np.array(refits)
+
+
+class RunningMoments:
+
+    # element-wise mean and variance of whatever arrays get added, a batch at
+    # a time, skipping NaNs (Chan et al.'s update for merging two sets)
+    def __init__(self, shape):
+        self.n, self.mean, self.m2 = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=float)
+        n = (~np.isnan(batch)).sum(axis=0)
+        mean = np.nansum(batch, axis=0) / np.maximum(n, 1)
+        m2 = np.nansum((batch - mean) ** 2, axis=0)
+
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / np.maximum(total, 1)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * n / np.maximum(total, 1)
+        self.n = total
+
+    @property
+    def sd(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+
+
+class RunningCorrelation:
+
+    # Pearson correlation between pairs of columns, from running sums
+    def __init__(self, size):
+        self.n = 0
+        self.sums = {name: np.zeros(size) for name in ("x", "y", "xx", "yy", "xy")}
+
+    def update(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        self.n += len(x)
+        for name, values in (("x", x), ("y", y), ("xx", x * x), ("yy", y * y), ("xy", x * y)):
+            self.sums[name] += values.sum(axis=0)
+
+    @property
+    def r(self):
+        s = self.sums
+        covariance = s["xy"] - s["x"] * s["y"] / self.n
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return covariance / np.sqrt((s["xx"] - s["x"] ** 2 / self.n) * (s["yy"] - s["y"] ** 2 / self.n))
+
+
+def bootstrap_fits(data_directory, best, replicates, processes=None, seed=None):
+
+    # `best` is one row per subject, as from `best_fits`
+    if seed is None:
+        seed = np.random.SeedSequence().entropy % 2 ** 63
+
+    subjects = best.to_dict("records")
+    generating, observed, stays, params = {}, {}, {}, {}
+    at_least = {}                                                               # how many datasets stayed at least as often as the subject, per cell
+    recovery = RunningCorrelation(len(PARAM_NAMES))
+
+    with ProcessPoolExecutor(processes) as pool:
+        futures = []
+        for subject_index, subject in enumerate(subjects):
+            key = subject["subject"]
+            x = generating[key] = np.array([subject[param] for param in PARAM_NAMES], dtype=float)
+            bounds = [(subject[param + "_lb"], subject[param + "_ub"]) for param in PARAM_NAMES]
+
+            observed[key] = stay_probabilities(load_trials(data_directory=data_directory, sub_path=key + ".csv"))
+            stays[key], params[key] = RunningMoments(observed[key].shape), RunningMoments(len(PARAM_NAMES))
+            at_least[key] = np.zeros(observed[key].shape)
+
+            for chunk, first in enumerate(range(0, replicates, REPLICATES_PER_TASK)):
+                futures.append(pool.submit(replicate_chunk, key, x, bounds, bool(subject["include_priors"]),
+                                           int(subject["trials"]), min(REPLICATES_PER_TASK, replicates - first),
+                                           [seed, subject_index, chunk]))
+
+        for future in as_completed(futures):
+            key, chunk_stays, refits = future.result()
+            stays[key].update(chunk_stays)
+            params[key].update(refits)
+            at_least[key] += (chunk_stays >= observed[key]).sum(axis=0)
+            recovery.update(generating[key], refits)
+
+    stay_rows, param_rows = [], []
+    for subject in subjects:
+        key = subject["subject"]
+        for reward_index, reward in enumerate(REWARDS):
+            for stake_index, stake in enumerate(STAKE_TYPES):
+                cell = (reward_index, stake_index)
+                stay_rows.append({"subject": key, "reward": reward, "stake_type": stake,
+                                  "observed": observed[key][cell], "simulated_mean": stays[key].mean[cell],
+                                  "simulated_sd": stays[key].sd[cell], "datasets": int(stays[key].n[cell]),
+                                  "share_at_least": at_least[key][cell] / max(stays[key].n[cell], 1)})
+        for param_index, param in enumerate(PARAM_NAMES):
+            param_rows.append({"subject": key, "param": param, "fitted": subject[param],
+                               "refit_mean": params[key].mean[param_index], "refit_sd": params[key].sd[param_index],
+                               "datasets": int(params[key].n[param_index])})
+
+    recovery_rows = pd.DataFrame({"param": PARAM_NAMES, "r": recovery.r, "datasets": recovery.n, "seed": seed})
+    return pd.DataFrame(stay_rows), pd.DataFrame(param_rows), recovery_rows
+
+
+if __name__ == '__main__':
+    from run_wrapper import data_dir, experiment_dir, results_dir
+    from results_store import best_fits
+
+    replicates = int(argv[1]) if len(argv) > 1 else 100
+    processes = int(argv[2]) if len(argv) > 2 else None
+    seed = int(argv[3]) if len(argv) > 3 else None
+
+    stay_table, param_table, recovery_table = bootstrap_fits(data_dir, best_fits(results_dir), replicates,
+                                                             processes, seed)
+
+    out_dir = path.join(experiment_dir, "bootstrap")
+    makedirs(out_dir, exist_ok=True)
+    stay_table.to_csv(path.join(out_dir, "stay_probabilities.csv"), index=False)
+    param_table.to_csv(path.join(out_dir, "parameters.csv"), index=False)
+    recovery_table.to_csv(path.join(out_dir, "recovery.csv"), index=False)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulates many agents at once, for parameter recovery.
+
+`simulate` in `wrapper.py` runs a single `Agent` trial by trial, drawing each
+trial's rocket pair, stakes and sides, and each planet's random walk step, one
+at a time. `simulate_many` takes a whole matrix of parameters (one row per
+agent, in the same column order as `params` in `mle`) and steps every agent
+through its trials together: each line in the trial loop below works on all of
+the agents at once, and every random draw comes from one seeded
+`np.random.Generator`.
+
+With a `reward_seed`, every agent plays against the same payoffs (see
+`reward_schedule.py`) instead of each getting its own random walk.
+
+The agents follow the same rules as `Agent` in "simulate" mode, and the output
+has the same 27 columns as `simulate`'s (see `Agent`), plus an `agent` column
+saying which row of the parameter matrix each trial belongs to. As in
+`Agent.log`, the Q values on each row are the ones going into that trial, i.e.,
+before `q_integrate` runs.
+"""
+
+import numpy as np
+from pandas import DataFrame
+from simulate_and_model import PlanetObj, STAKE_TYPES
+from wrapper import extract_key_variables
+from reward_schedule import reward_schedule
+
+
+@extract_key_variables
+def simulate_many(rocket_pairs, pair_sides, planets, param_sets, trials, seed=None, reward_seed=None):
+
+    param_sets = np.asarray(param_sets, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    α, β, λ, π, ρ = param_sets[:, 0:5].T
+    ws = param_sets[:, 5:]
+
+    n_agents, n_pairs, n_planets, trials = len(param_sets), len(rocket_pairs), len(planets), int(trials)
+    agents = np.arange(n_agents)
+    options = np.arange(n_planets)
+
+    Qtd, Q, Qplus = (np.full((n_agents, n_pairs, n_planets), .5) for _ in range(3))
+    Qp = np.full((n_agents, n_planets), .5)                                     # the planets' Qs, which are also every rocket pair's Qmbs
+
+    if reward_seed is None:
+        treasure = random_walk(np.full((n_agents, n_planets), (PlanetObj.rwalk_min + PlanetObj.rwalk_max) / 2), rng)
+    else:
+        schedule = reward_schedule(reward_seed, trials, n_planets)             # every agent gets the same payoffs
+        treasure = np.broadcast_to(schedule[0], (n_agents, n_planets))
+
+    prev_pair, prev_side, prev_planet = (np.full(n_agents, -1) for _ in range(3))  # -1 means there's no previous trial yet
+
+    log = {}                                                                    # one array per variable, trials x agents (x rocket pairs x planets, for the Qs)
+
+    for t in range(trials):
+
+        # this trial's conditions, the same way `simulate` draws them
+        pair = rng.integers(n_pairs, size=n_agents)
+        stake = np.where(pair == 0, STAKE_TYPES.index("high"), STAKE_TYPES.index("low"))
+        stake = np.where(rng.uniform(size=n_agents) <= 2/3, stake,
+                         np.where(pair == 0, STAKE_TYPES.index("faux_high"), STAKE_TYPES.index("faux_low")))
+        side = rng.integers(len(pair_sides), size=n_agents)
+
+        record(log, t, trials, trial_index=np.full(n_agents, t), og_pair=pair, pair_sides=side,
+               stake_type=stake, Qtd=Qtd, Q=Q, Qplus=Qplus, Qp=Qp)
+
+        # `RocketPairObj.q_integrate`
+        w = ws[agents, stake][:, None]
+        new_q = Qp * w + Qtd[agents, pair] * (1 - w)
+
+        went_there = prev_planet[:, None] == options
+        stay_bonus = went_there & (prev_pair == pair)[:, None]
+        side_bonus = (went_there == (prev_side == side)[:, None]) & (prev_planet >= 0)[:, None]
+
+        Q[agents, pair] = new_q
+        Qplus[agents, pair] = new_q + stay_bonus * π[:, None] + side_bonus * ρ[:, None]
+
+        # `Agent.planet_selection`
+        choice_values = Qplus[agents, pair] * β[:, None]
+        weighted_choices = np.exp(choice_values - choice_values.max(axis=1, keepdims=True))   # taking off the biggest value keeps `np.exp` from overflowing
+        weighted_choices /= weighted_choices.sum(axis=1, keepdims=True)
+
+        planet = (rng.uniform(size=(n_agents, 1)) > weighted_choices.cumsum(axis=1)).sum(axis=1)
+        planet = np.minimum(planet, n_planets - 1)                              # guards against the cumulative sum coming out a hair under 1
+        p_choice = weighted_choices[agents, planet]
+
+        # `Agent.q_update`
+        payoff = treasure[agents, planet]
+        rpe1 = Qp[agents, planet] - Qtd[agents, pair, planet]
+        rpe2 = payoff - Qp[agents, planet]
+
+        Qtd[agents, pair, planet] += rpe1 * α
+        Qp[agents, planet] += rpe2 * α
+        Qtd[agents, pair, planet] += rpe2 * α * λ
+
+        record(log, t, trials, p_choice=p_choice, planet=planet, points=payoff, rpe1=rpe1, rpe2=rpe2)
+
+        # `Agent.remaining_updates`
+        if reward_seed is None:
+            treasure = random_walk(treasure, rng)
+        elif t + 1 < trials:
+            treasure = np.broadcast_to(schedule[t + 1], (n_agents, n_planets))
+        prev_pair, prev_side, prev_planet = pair, side, planet
+
+    return to_data_frame(log, n_agents, trials, rocket_pairs, pair_sides, planets)
+
+
+def random_walk(treasure, rng):
+
+    # `PlanetObj.random_walk` for every planet of every agent at once
+    treasure = np.round(treasure + rng.normal(PlanetObj.rwalk_mean, PlanetObj.rwalk_sd, treasure.shape))
+
+    while True:
+        above, below = treasure > PlanetObj.rwalk_max, treasure < PlanetObj.rwalk_min
+        if not (above.any() or below.any()):
+            return treasure
+
+        treasure = np.where(above, 2 * PlanetObj.rwalk_max - treasure, treasure)
+        treasure = np.where(below, 2 * PlanetObj.rwalk_min - treasure, treasure)
+
+
+def record(log, t, trials, **columns):
+    for name, values in columns.items():
+        if name not in log:
+            log[name] = np.empty((trials,) + values.shape, dtype=values.dtype)
+        log[name][t] = values                                                   # copies, so later updates to e.g. `Qtd` don't touch what's been logged
+
+
+def to_data_frame(log, n_agents, trials, rocket_pairs, pair_sides, planets):
+
+    def long(values):                                                           # trials x agents -> agent by agent, trial by trial
+        return values.swapaxes(0, 1).reshape(n_agents * trials, *values.shape[2:])
+
+    columns = {
+        "agent": np.repeat(np.arange(n_agents), trials),
+        "trial_index": long(log["trial_index"]),
+        "og_pair": np.array(rocket_pairs, dtype=object)[long(log["og_pair"])],
+        "pair_sides": np.array(pair_sides, dtype=object)[long(log["pair_sides"])],
+        "stake_type": np.array(STAKE_TYPES, dtype=object)[long(log["stake_type"])]
+    }
+
+    for pair_index, pair_name in enumerate(rocket_pairs):
+        for q_type in ("Qtd", "Qmb", "Q", "Qplus"):
+            for planet_index, planet_name in enumerate(planets):
+                if q_type == "Qmb":
+                    values = long(log["Qp"])[:, planet_index]                   # every rocket pair's Qmbs are just the planets' Qs
+                else:
+                    values = long(log[q_type])[:, pair_index, planet_index]
+                columns[q_type + '(' + pair_name + ',' + planet_name + ')'] = values
+
+    for planet_index, planet_name in enumerate(planets):
+        columns['Q(' + planet_name + ')'] = long(log["Qp"])[:, planet_index]
+
+    columns["p_choice"] = long(log["p_choice"])
+    columns["planet"] = np.array(planets, dtype=object)[long(log["planet"])]
+    for name in ("points", "rpe1", "rpe2"):
+        columns[name] = long(log[name])
+
+    return DataFrame(columns)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Remembers the best fit found so far for each subject under each model
+configuration, so reruns don't have to start from scratch.
+
+An entry is keyed on the subject, a hash of the subject's trials (as compiled
+by `load_trials`, so re-splicing the same raw data gives the same hash), and a
+hash of the settings that change what's being minimized: `include_priors`,
+the bounds, the priors, and `MODEL_VERSION`. It holds the best optimum (`x`,
+`fun`, and L-BFGS-B's inverse-Hessian approximation there, as a 9 x 9 matrix)
+along with every start that has been fit under that configuration. Changing
+the trials or any of those settings means a new entry, rather than reusing a
+stale one.
+
+`cached_fit` is what `run_wrapper.py` and `fit_pool.py` fit through: a start
+that has already been fit under the same configuration (or that starts right
+at the cached optimum) gets skipped, and hands back the cached optimum
+instead. `prep_params_for_cluster.py` uses `seed_start` to replace each
+subject's first random start with the cached optimum, if there is one, moved
+inside the new bounds if need be.
+
+Each entry is its own `.npz` file under the cache folder. Two tasks finishing
+fits of the same subject and configuration at the same moment can lose one of
+the two updates, which only costs a cache miss later on.
+"""
+
+from os import path, makedirs, replace
+from glob import glob
+from hashlib import sha1
+from uuid import uuid4
+import numpy as np
+from simulate_and_model import DEFAULT_PRIORS
+from wrapper import PARAM_NAMES, model, load_trials
+
+
+MODEL_VERSION = 1                                                               # bump whenever the likelihood changes, so that optima from the old one stop counting
+
+
+def trial_hash(trials):
+    digest = sha1()
+    for field in trials:
+        digest.update(np.ascontiguousarray(field).tobytes())
+    return digest.hexdigest()[0:16]
+
+
+def config_hash(include_priors, bounds, priors=None):
+    settings = (MODEL_VERSION, bool(include_priors), [(float(lb), float(ub)) for lb, ub in bounds],
+                [(family, float(a), float(b)) for family, a, b in priors or DEFAULT_PRIORS])
+    return sha1(repr(settings).encode()).hexdigest()[0:16]
+
+
+def bounds_of(params):
+    return [(params[param + "_lb"], params[param + "_ub"]) for param in PARAM_NAMES]
+
+
+def start_of(params):
+    return np.array([params[param + "_0"] for param in PARAM_NAMES], dtype=float)
+
+
+class FitCache:
+
+    def __init__(self, root):
+        self.root = root
+        makedirs(root, exist_ok=True)
+
+    def entry_path(self, subject, data_hash, config):
+        return path.join(self.root, f"{subject}-{data_hash}-{config}.npz")
+
+    def lookup(self, subject, data_hash, config):
+        entry_path = self.entry_path(subject, data_hash, config)
+        if not path.exists(entry_path):
+            return None
+
+        with np.load(entry_path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def record(self, subject, data_hash, config, x0, fit):
+        entry = self.lookup(subject, data_hash, config)
+        hess_inv = fit.hess_inv.todense() if hasattr(fit, "hess_inv") else np.full((len(x0), len(x0)), np.nan)
+
+        if entry is None:
+            entry = {"x": fit.x, "fun": np.array(fit.fun), "hess_inv": hess_inv, "starts": np.empty((0, len(x0)))}
+        elif fit.fun < entry["fun"]:
+            entry.update(x=fit.x, fun=np.array(fit.fun), hess_inv=hess_inv)
+
+        entry["starts"] = np.vstack([entry["starts"], x0])
+
+        entry_path = self.entry_path(subject, data_hash, config)
+        temporary = entry_path + "." + uuid4().hex.upper()[0:10] + ".tmp"
+        with open(temporary, "wb") as file:                                    # through a file object, since `np.savez` would tack ".npz" onto the temporary name
+            np.savez(file, **entry)
+        replace(temporary, entry_path)
+
+    def seed_start(self, subject, data_hash, config, bounds):
+
+        # the cached optimum for this configuration if there is one, otherwise
+        # the most recently updated one for the same trials under any other
+        # configuration (e.g., before the bounds changed)
+        entry = self.lookup(subject, data_hash, config)
+        if entry is None:
+            others = sorted(glob(self.entry_path(subject, data_hash, "*")), key=path.getmtime)
+            if not others:
+                return None
+            with np.load(others[-1]) as npz:
+                entry = {"x": npz["x"]}
+
+        lb, ub = np.array(bounds, dtype=float).T
+        return np.clip(entry["x"], lb, ub)
+
+
+def fit_before(entry, x0):
+    return any(np.allclose(x0, start) for start in entry["starts"]) or np.allclose(x0, entry["x"])
+
+
+def cached_fit(cache, data_directory, params, trials=None, resumed=None, **model_kwargs):
+
+    # `params` is a row of the job manifest, as from `job_params`;
+    # `trials` can be passed in if they've already been loaded. `resumed`,
+    # if given, is the same row starting from somewhere else (e.g., a
+    # checkpoint; see `resume_params`), which is where the optimizer starts,
+    # but the cache still goes by the row's own start, so that the row counts
+    # as fit on later runs
+    if trials is None:
+        trials = load_trials(data_directory=data_directory, sub_path=params["sub_path"])
+
+    fit_params = params if resumed is None else resumed
+
+    if cache is None:
+        return model(data_directory=data_directory, **{**fit_params, "sub_path": trials}, **model_kwargs)
+
+    key = (path.splitext(params["sub_path"])[0], trial_hash(trials),
+           config_hash(params["include_priors"], bounds_of(params)))
+    x0 = start_of(params)
+
+    entry = cache.lookup(*key)
+    if entry is not None and fit_before(entry, x0):
+        from scipy.optimize import OptimizeResult
+        return OptimizeResult(x=entry["x"], fun=float(entry["fun"]), nit=0, nfev=0, success=True, status=0,
+                              message="already fit; taken from the fit cache", trials=len(trials.pair))
+
+    fit = model(data_directory=data_directory, **{**fit_params, "sub_path": trials}, **model_kwargs)
+    cache.record(*key, x0, fit)
+
+    return fit
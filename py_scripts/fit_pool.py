@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fits a block of rows of the job manifest (see `job_manifest.py`) across a
+local process pool, rather than giving every row its own array task (and so
+its own python interpreter and imports).
+
+    python fit_pool.py [TASK_ID ROWS_PER_TASK [PROCESSES [AGREE_NEEDED]]]
+
+The manifest keeps each subject's starts together, so a block holds runs of
+starts for the same subjects. Within a block, each
+subject's starts go to the same worker, which reads and compiles that
+subject's trials once and then fits all of the subject's starts. The fits go
+into the same parquet dataset as `run_wrapper.py`'s (see `results_store.py`),
+one part file per subject. With no arguments, every row in the manifest gets
+fit.
+
+If AGREE_NEEDED is given, a subject's starts race each other (see
+`StartRace`): a start gets stopped early once it's clearly heading for an
+optimum that an earlier start already found, or once it has stalled above the
+best optimum found so far, and once AGREE_NEEDED starts have landed on the
+same best optimum, the subject's remaining starts are skipped altogether.
+
+Starts that have already been fit under the same configuration get skipped as
+well (see `fit_cache.py`), and rows that `prep_params_for_cluster.py` found in
+the fit cache (marked "cached"; see `run_state.py`) don't get fit or written
+again at all.
+"""
+
+from sys import argv
+from os import path, cpu_count
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.optimize import OptimizeResult
+from wrapper import PARAM_NAMES, load_trials
+from run_wrapper import data_dir, experiment_dir, results_dir, cache_dir, state_dir
+from results_store import ResultWriter
+from fit_cache import FitCache, cached_fit
+from job_manifest import MANIFEST_NAME, open_manifest, manifest_rows
+from instrument import instrumented
+from run_state import RunState
+
+
+def fit_subject(data_directory, sub_path, rows, agree_needed=None, cache=None):
+
+    trials = load_trials(data_directory=data_directory, sub_path=sub_path)
+
+    if agree_needed is not None:
+        return race_subject(data_directory, sub_path, trials, rows, agree_needed, cache)
+
+    fits = []
+    for index, params in rows:
+        fit = instrumented(cached_fit, cache, data_directory, params, trials)
+        fits.append((index, {**params, **fit}))
+
+    return fits
+
+
+def race_subject(data_directory, sub_path, trials, rows, agree_needed, cache=None):
+
+    race = StartRace([(rows[0][1][param + "_lb"], rows[0][1][param + "_ub"]) for param in PARAM_NAMES],
+                     agree_needed)
+
+    fits = []
+    for index, params in rows:
+        if race.settled():
+            break
+
+        try:
+            fit = instrumented(cached_fit, cache, data_directory, params, trials, callback=race.watch())   # starts that get stopped early never make it into the cache
+            race.record(fit.fun, fit.x)
+
+        except StopStart as stop:
+            fit = stop.result(len(trials.pair))
+            if hasattr(stop, "instruments"):
+                fit["instruments"] = stop.instruments                           # only there when the fits are instrumented
+
+        fits.append((index, {**params, **fit}))
+
+    return fits                                                                 # starts stopped early show up in the results with status 3, and skipped ones in `run_state`
+
+
+class StopStart(Exception):
+
+    def __init__(self, x, fun, nit, reason):
+        super().__init__(reason)
+        self.x, self.fun, self.nit, self.reason = np.copy(x), fun, nit, reason
+
+    def result(self, trials):
+        return OptimizeResult(x=self.x, fun=self.fun, nit=self.nit, nfev=None, success=False,
+                              status=3, message="stopped early: " + self.reason, trials=trials)   # L-BFGS-B itself only uses statuses 0 through 2
+
+
+class StartRace:
+
+    # keeps track of the optima that one subject's starts have found so far,
+    # and hands each new start a callback that stops it (by raising
+    # `StopStart`) once finishing it looks pointless. Parameters count as
+    # "the same" when every one of them is within `x_tol` of the width of its
+    # bounds, and objectives when they're within `fun_tol`
+    def __init__(self, bounds, agree_needed, fun_tol=1e-2, x_tol=1e-2, patience=5):
+        self.width = np.array([ub - lb for lb, ub in bounds])
+        self.agree_needed = agree_needed
+        self.fun_tol = fun_tol
+        self.x_tol = x_tol
+        self.patience = patience
+        self.optima = []                                                        # (fun, x) for every start that ran to convergence
+        self.votes = []                                                         # the optimum each finished or redirected start ended up at
+
+    def watch(self):
+        history = []
+
+        def callback(xk, fun):
+            if fun is not None:
+                history.append(fun)
+
+            if not self.optima:
+                return
+
+            for optimum in self.optima:
+                if self.same_x(xk, optimum[1]):
+                    self.votes.append(optimum)
+                    raise StopStart(xk, fun, len(history), "heading for an optimum another start already found")
+
+            best_fun = self.best()[0]
+            if (len(history) > self.patience and history[-1] > best_fun + self.fun_tol and
+                    history[-1 - self.patience] - history[-1] < self.fun_tol):
+                raise StopStart(xk, fun, len(history), "stalled above the best optimum found so far")
+
+        return callback
+
+    def record(self, fun, x):
+        if np.isfinite(fun):
+            self.optima.append((fun, np.copy(x)))
+            self.votes.append(self.optima[-1])
+
+    def best(self):
+        return min(self.optima, key=lambda optimum: optimum[0])
+
+    def agreeing(self):
+        if not self.optima:
+            return 0
+
+        best_fun, best_x = self.best()
+        return sum(abs(fun - best_fun) < self.fun_tol and self.same_x(x, best_x) for fun, x in self.votes)
+
+    def settled(self):
+        return self.agreeing() >= self.agree_needed
+
+    def same_x(self, x, other_x):
+        return np.all(np.abs(x - other_x) / self.width < self.x_tol)
+
+
+def rows_for_task(manifest, task_id, rows_per_task):
+    return manifest_rows(manifest, (task_id - 1) * rows_per_task, task_id * rows_per_task)   # only this block's rows of the manifest get read
+
+
+def fit_rows(rows, data_directory, results_root, task_id=0, processes=None, agree_needed=None, cache=None,
+             state=None):
+
+    # `rows` is a list of (index, params) pairs, as from `manifest_rows`
+    by_subject = {}
+    for index, params in rows:
+        by_subject.setdefault(params["sub_path"], []).append((index, params))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor, ResultWriter(results_root, task_id) as writer:
+        jobs = {
+            executor.submit(fit_subject, data_directory, sub_path, sub_rows, agree_needed, cache): sub_rows
+            for sub_path, sub_rows in by_subject.items()
+        }
+
+        for job in as_completed(jobs):
+            fits = job.result()
+            for index, results in fits:
+                writer.add(index, results)
+            writer.flush()                                                      # one part file per subject, so a task that gets killed partway through keeps the subjects it finished
+
+            if state is not None:                                               # see `run_state.py`
+                for index, results in fits:
+                    state.finish(index, results)
+                for index, _ in jobs[job][len(fits):]:
+                    state.skip(index)                                           # the rest of the subject's starts, which the race didn't need
+
+
+if __name__ == '__main__':
+
+    manifest = open_manifest(path.join(experiment_dir, MANIFEST_NAME))
+
+    task_id = int(argv[1]) if len(argv) > 2 else 0
+    rows = rows_for_task(manifest, task_id, int(argv[2])) if len(argv) > 2 else manifest_rows(manifest)
+
+    processes = int(argv[3]) if len(argv) > 3 else cpu_count()
+    agree_needed = int(argv[4]) if len(argv) > 4 else None
+
+    state = RunState(state_dir, manifest)
+    rows = [(index, params) for index, params in rows if state.status(index) != "cached"]
+
+    fit_rows(rows, data_dir, results_dir, task_id, processes, agree_needed, FitCache(cache_dir), state)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fits every subject at once, with the priors themselves estimated from the
+group (empirical Bayes), rather than fixed at `DEFAULT_PRIORS`.
+
+    python hierarchical.py [PROCESSES [MAX_ITERATIONS]]
+
+Each outer iteration refits every subject under the current priors (the
+E-step), and then sets each parameter's prior to match the spread of the
+subjects' estimates (the M-step), using a Laplace approximation to each
+subject's posterior: its mode, and variances from the inverse of the Hessian
+of the negative log posterior there. This goes on until the priors stop
+changing, or for MAX_ITERATIONS iterations.
+
+Only the prior term changes from one outer iteration to the next, so the
+subjects' trials get loaded once, when each worker process starts up, and stay
+in the worker for every iteration after that; each subject's refit starts from
+where its previous fit ended up. L-BFGS-B's own memory can't be handed back to
+scipy, so that part of the optimizer starts fresh each time.
+
+Subjects start from their best fit so far in `fit_results` (see
+`results_store.py`) if they have one, and from the first of their starts in the
+job manifest (see `job_manifest.py`) otherwise. The estimated priors go to
+`hierarchical_priors.csv`, and each subject's final fit (and its Laplace
+variances) to `hierarchical_fits.csv`, both in the experiment's folder.
+"""
+
+from sys import argv
+from os import path, cpu_count
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from simulate_and_model import DEFAULT_PRIORS
+from wrapper import PARAM_NAMES, load_trials, fit_trials
+from likelihood import batch_neg_log_posterior, finite_difference_hessian
+
+
+_resident = {}                                                                  # each worker's compiled trials, by subject
+
+
+def load_subjects(data_directory, subjects):
+    for sub_path in subjects:
+        _resident[sub_path] = load_trials(data_directory=data_directory, sub_path=sub_path)
+
+
+def refit(sub_path, x0, bounds, priors):
+    trials = _resident[sub_path]
+
+    fit = fit_trials(trials, x0, bounds, True, priors=priors)
+    variances = laplace_variances(fit.x, trials, bounds, priors)
+
+    return sub_path, fit, variances
+
+
+def laplace_variances(x, trials, bounds, priors, floor=1e-6):
+    hessian = finite_difference_hessian(
+        lambda param_sets: batch_neg_log_posterior(param_sets, trials, True, True, priors)[1], x, bounds)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(hessian)                         # modes that sit against a bound needn't be curved upward, so keep it positive definite
+    covariance = eigenvectors @ np.diag(1 / np.maximum(eigenvalues, floor)) @ eigenvectors.T
+
+    return np.diag(covariance)
+
+
+def update_priors(modes, variances, priors):
+
+    # moment matching: each parameter's prior gets the mean and variance of
+    # the subjects' Laplace posteriors pooled together
+    new_priors = []
+
+    for mode, variance, (family, _, _) in zip(modes.T, variances.T, priors):
+        μ = mode.mean()
+        s2 = np.mean(mode ** 2 + variance) - μ ** 2
+
+        if family == "normal":
+            new_priors.append((family, μ, np.sqrt(s2)))
+
+        elif family == "gamma":
+            shape = max(μ ** 2 / s2, 1)                                         # like the beta's shapes below: under 1, the density goes off to infinity at 0
+            new_priors.append((family, shape, μ / shape))                       # shape, scale (s2 / μ unless the shape got floored; either way the mean stays μ)
+
+        else:
+            common = μ * (1 - μ) / s2 - 1
+            new_priors.append((family, max(μ * common, 1), max((1 - μ) * common, 1)))   # shapes under 1 would send the density off to infinity at 0 or 1
+
+    return tuple(new_priors)
+
+
+def fit_group(data_directory, starts, bounds, priors=DEFAULT_PRIORS, processes=None, max_iterations=50, tol=1e-3):
+
+    # `starts` maps each subject's spliced csv to where its first fit starts
+    subjects = list(starts)
+    x = {sub_path: np.asarray(x0, dtype=float) for sub_path, x0 in starts.items()}
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=load_subjects,
+                             initargs=(data_directory, subjects)) as executor:
+
+        for iteration in range(max_iterations):
+            fits, variances = {}, {}
+            for sub_path, fit, variance in executor.map(refit, subjects, [x[sub_path] for sub_path in subjects],
+                                                         [bounds] * len(subjects), [priors] * len(subjects)):
+                x[sub_path], fits[sub_path], variances[sub_path] = fit.x, fit, variance
+
+            new_priors = update_priors(np.array([x[sub_path] for sub_path in subjects]),
+                                       np.array([variances[sub_path] for sub_path in subjects]), priors)
+
+            change = max(abs(new[1] - old[1]) / (abs(old[1]) + 1) + abs(new[2] - old[2]) / (abs(old[2]) + 1)
+                         for new, old in zip(new_priors, priors))
+            print(f"iteration {iteration + 1}: priors moved by {change:.2g}")
+
+            priors = new_priors
+            if change < tol:
+                break
+
+    return priors, fits, variances
+
+
+if __name__ == '__main__':
+    from run_wrapper import data_dir, experiment_dir, results_dir
+    from results_store import best_fits
+    from job_manifest import MANIFEST_NAME, open_manifest, job_params
+
+    manifest = open_manifest(path.join(experiment_dir, MANIFEST_NAME))
+    first_rows = {}
+    for index, sub_path in enumerate(manifest["sub_path"].tolist()):
+        first_rows.setdefault(sub_path, job_params(manifest, index))
+
+    bounds = [(manifest["lb"][0][param_index], manifest["ub"][0][param_index]) for param_index in range(len(PARAM_NAMES))]
+
+    best = best_fits(results_dir).set_index("subject")
+    starts = {}
+    for sub_path, params in first_rows.items():
+        subject = path.splitext(sub_path)[0]
+        source, suffix = (best.loc[subject], "") if subject in best.index else (params, "_0")
+        starts[sub_path] = [source[param + suffix] for param in PARAM_NAMES]
+
+    processes = int(argv[1]) if len(argv) > 1 else cpu_count()
+    max_iterations = int(argv[2]) if len(argv) > 2 else 50
+
+    priors, fits, variances = fit_group(data_dir, starts, bounds, processes=processes, max_iterations=max_iterations)
+
+    pd.DataFrame(priors, index=PARAM_NAMES, columns=["family", "a", "b"]).to_csv(
+        path.join(experiment_dir, "hierarchical_priors.csv"), index_label="param")
+
+    pd.DataFrame([
+        {"subject": path.splitext(sub_path)[0],
+         **dict(zip(PARAM_NAMES, fit.x)),
+         **{param + "_var": variance for param, variance in zip(PARAM_NAMES, variances[sub_path])},
+         "fun": fit.fun, "success": fit.success}
+        for sub_path, fit in fits.items()
+    ]).to_csv(path.join(experiment_dir, "hierarchical_fits.csv"), index=False)
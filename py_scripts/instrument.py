@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in timing and counting for fits, to see where a slow fit spends its time.
+
+With the environment variable `INSTRUMENT_FITS` set (e.g.,
+`INSTRUMENT_FITS=1 sbatch run_all_blocks.sh`), every fit run by
+`run_wrapper.py` or `fit_pool.py` gets an `Instruments`, and a compact summary
+of each fit gets saved next to its results (see `ResultWriter` in
+`results_store.py`): how many times the objective was evaluated, how long the
+fit took, how much of that went to the objective and to the priors (the rest
+is scipy's own overhead), how long each phase of a trial took across every
+replay of the trials (see below), and the objective and parameters at every
+iteration of the optimizer. Starts that `fit_pool.py` stops early keep their
+summary too, up to the point where they were stopped.
+
+The phases of a trial in the engine fits use (`likelihood.replay_one`) are
+`q_integrate`, `planet_selection` (the softmax), `gradient` (the likelihood's
+gradient and the Q values' sensitivities, only when there's a gradient), and
+`q_update`. Inside a `with Instruments()` block, `replay_one` is swapped for
+`replay_one_timed`, which times each one with a lap of the clock as it ends,
+so the clock's own overhead (tens of nanoseconds a lap) is in there too, which
+isn't nothing next to a trial's microsecond or so. Replays of more than one
+agent (`likelihood.replay` proper) don't get split into phases.
+
+`mle` takes an `Instruments` as well, in which case its `Agent` times the same
+phases (minus `gradient`), plus `log_var` and `log_qs` (logging), and
+`remaining_updates`. Phases that call other phases (e.g., `planet_selection`
+calling `log_var`) include them in their own time.
+
+Nothing here gets in the way when it's off: methods only get wrapped on the
+instances being instrumented, and the prior functions and `replay_one` only
+get swapped for timed ones inside a `with Instruments()` block, so
+uninstrumented fits run exactly the same code as before.
+"""
+
+from os import environ
+from collections import defaultdict
+from time import perf_counter
+import numpy as np
+import simulate_and_model
+import likelihood
+
+
+ENABLED = "INSTRUMENT_FITS"
+
+
+class Instruments:
+
+    def __init__(self):
+        self.phases = defaultdict(lambda: [0, 0.])                              # name -> [calls, seconds]
+        self.trajectory = []                                                    # (fun, x) at each iteration
+        self.fits = []                                                          # (seconds, nit, fun) for each fit
+        self.patched = []
+
+    def timed(self, name, func):
+        phase = self.phases[name]
+
+        def timed_func(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phase[0] += 1
+                phase[1] += perf_counter() - start
+
+        return timed_func
+
+    def __enter__(self):
+        for module in (simulate_and_model, likelihood):
+            for name in ("log_prior_densities", "prior_gradient"):
+                original = getattr(module, name)
+                self.patched.append((module, name, original))
+                setattr(module, name, self.timed("priors", original))
+
+        self.patched.append((likelihood, "replay_one", likelihood.replay_one))
+        likelihood.replay_one = self.timed_replay_one
+        return self
+
+    def __exit__(self, *exc_info):
+        for module, name, original in self.patched:
+            setattr(module, name, original)
+        self.patched = []
+
+    def timed_replay_one(self, *args, **kwargs):
+        return likelihood.replay_one_timed(self.lap_timer(), *args, **kwargs)
+
+    def lap_timer(self):
+
+        # for `likelihood.replay_one_timed`: a function that puts the time
+        # since it was last called (or since it was made) down to the phase
+        # it's called with
+        last = [perf_counter()]
+
+        def lap(name):
+            now = perf_counter()
+            phase = self.phases[name]
+            phase[0] += 1
+            phase[1] += now - last[0]
+            last[0] = now
+
+        return lap
+
+    def instrument_agent(self, agent):
+        for name in ("planet_selection", "q_update", "log_var", "log_qs", "remaining_updates"):
+            setattr(agent, name, self.timed(name, getattr(agent, name)))
+
+        for rocket_pair_obj in agent.rocket_pair_objs.values():
+            rocket_pair_obj.q_integrate = self.timed("q_integrate", rocket_pair_obj.q_integrate)
+
+    def watch(self, objective, callback=None):
+
+        # a timed objective (which counts evaluations as well), and a callback
+        # that keeps track of where the optimizer has been before passing
+        # things on to `callback`
+        def on_iteration(xk, fun):
+            self.trajectory.append((fun, np.copy(xk)))
+            if callback is not None:
+                callback(xk, fun)
+
+        return self.timed("objective", objective), on_iteration
+
+    def record_fit(self, fit, seconds):
+        self.fits.append((seconds, None, None) if fit is None else (seconds, fit.nit, fit.fun))   # None for a fit that got stopped before it finished
+
+    def summary(self):
+        fit_seconds = sum(seconds for seconds, _, _ in self.fits)
+        objective_seconds = self.phases["objective"][1] if "objective" in self.phases else 0
+
+        return {
+            "evaluations": self.phases["objective"][0] if "objective" in self.phases else 0,
+            "fit_seconds": fit_seconds,
+            "scipy_seconds": fit_seconds - objective_seconds,
+            "phases": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.phases.items()},
+            "trajectory": [[None if fun is None else float(fun)] + xk.tolist() for fun, xk in self.trajectory]
+        }
+
+
+def instrumented(fit_func, *args, **kwargs):
+
+    # calls `fit_func` (e.g., `cached_fit`) as is, unless `INSTRUMENT_FITS` is
+    # set, in which case it gets an `Instruments` and its summary gets added
+    # to the fit under "instruments". If the fit gets stopped by an
+    # exception (e.g., `StopStart`), the summary so far goes along with it as
+    # the exception's `instruments`
+    if not environ.get(ENABLED):
+        return fit_func(*args, **kwargs)
+
+    with Instruments() as instruments:
+        try:
+            fit = fit_func(*args, instruments=instruments, **kwargs)
+        except Exception as error:
+            error.instruments = instruments.summary()
+            raise
+
+    fit["instruments"] = instruments.summary()
+    return fit
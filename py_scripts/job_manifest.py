@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The table of fitting jobs, as one binary `.npy` file that every task can
+memory-map and read just its own rows from, instead of every array task
+parsing the whole of a csv to get at one row.
+
+`prep_params_for_cluster.py` writes the manifest, with one row per start:
+which subject, which of that subject's starts it is, whether to include
+priors, the bounds, and a seed. A subject's starts sit next to each other, so
+a block of rows (see `fit_pool.py`) covers runs of whole subjects.
+
+The random starting values aren't stored at all; `job_params` works each
+row's out from the manifest's seed, the subject, and which of the subject's
+starts it is, so they come out the same every time the row gets read. The only
+starts that do get stored (in `x0`, which is otherwise NaN) are the ones taken
+from the fit cache (see `fit_cache.py`).
+
+Unless it's given a seed, `write_manifest` keeps the seed of the manifest it's
+replacing, so rerunning `prep_params_for_cluster.py` on the same data and
+settings hands every subject the same starts again, and the fit cache skips
+the ones it has already fit. Pass a new seed (or delete the old manifest) for
+new random starts.
+"""
+
+from os import path
+from zlib import crc32
+import numpy as np
+from wrapper import PARAM_NAMES
+from fit_cache import config_hash
+
+
+MANIFEST_NAME = "jobs.npy"
+
+
+def write_manifest(manifest_path, sub_paths, iterations, include_priors, bounds, seed=None, seeded_starts=None):
+
+    # `seeded_starts` maps subjects to where their first start should be,
+    # rather than a random start
+    if seed is None:
+        seed = stored_seed(manifest_path)                                       # the last run's, so its starts come back the same
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy % 2 ** 63                      # a fresh seed, which then gets saved with the manifest
+
+    n_params = len(PARAM_NAMES)
+    rows = np.zeros(len(sub_paths) * iterations, dtype=[
+        ("sub_path", "U" + str(max(len(sub_path) for sub_path in sub_paths))),
+        ("iteration", "i4"),
+        ("include_priors", "?"),
+        ("seed", "i8"),
+        ("lb", "f8", (n_params,)),
+        ("ub", "f8", (n_params,)),
+        ("x0", "f8", (n_params,))
+    ])
+
+    lb, ub = np.array(bounds, dtype=float).T
+    rows["sub_path"] = np.repeat(sub_paths, iterations)
+    rows["iteration"] = np.tile(np.arange(iterations), len(sub_paths))
+    rows["include_priors"] = include_priors
+    rows["seed"] = seed
+    rows["lb"], rows["ub"] = lb, ub
+    rows["x0"] = np.nan
+
+    for sub_index, sub_path in enumerate(sub_paths):
+        if seeded_starts and sub_path in seeded_starts:
+            rows["x0"][sub_index * iterations] = seeded_starts[sub_path]
+
+    np.save(manifest_path, rows)
+
+
+def stored_seed(manifest_path):
+    if not path.exists(manifest_path):
+        return None
+
+    seeds = np.load(manifest_path)["seed"]
+    return int(seeds[0]) if len(seeds) else None
+
+
+def open_manifest(manifest_path):
+    return np.load(manifest_path, mmap_mode="r")                                # nothing gets read until a row gets looked at
+
+
+def random_start(seed, sub_path, iteration, lb, ub):
+    return np.random.default_rng([int(seed), crc32(sub_path.encode()), int(iteration)]).uniform(lb, ub)   # by subject rather than by row, so adding subjects or starts doesn't move anyone else's
+
+
+def job_params(manifest, index):
+
+    # the row as a dictionary, with the same keys `wrapper.model` takes (and
+    # that the csv of parameters used to have as columns)
+    row = manifest[index]
+    x0 = row["x0"] if not np.isnan(row["x0"]).any() else random_start(row["seed"], str(row["sub_path"]),
+                                                                        row["iteration"], row["lb"], row["ub"])
+
+    params = {"sub_path": str(row["sub_path"]), "include_priors": bool(row["include_priors"])}
+    for param_index, param in enumerate(PARAM_NAMES):
+        params[param + "_0"] = float(x0[param_index])
+        params[param + "_lb"] = float(row["lb"][param_index])
+        params[param + "_ub"] = float(row["ub"][param_index])
+
+    return params
+
+
+def row_identity(manifest, index):
+
+    # what sets row `index` apart from the rows of any other manifest, since
+    # a new manifest can put a different subject, start, or bounds at the
+    # same row number
+    row = manifest[index]
+    return {"sub_path": str(row["sub_path"]), "iteration": int(row["iteration"]), "seed": int(row["seed"]),
+            "config": config_hash(bool(row["include_priors"]), list(zip(row["lb"], row["ub"])))}
+
+
+def manifest_rows(manifest, start=0, stop=None):
+    stop = len(manifest) if stop is None else min(stop, len(manifest))
+    return [(index, job_params(manifest, index)) for index in range(start, stop)]
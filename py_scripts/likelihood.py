@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Array-backed version of `mle` from `simulate_and_model.py`.
+
+`mle` builds a brand new `Agent` (plus its rocket pair and planet objects) every
+time the optimizer asks for a likelihood, and then walks `sub_df` row by row,
+looking Q values up in dictionaries keyed by planet names. None of that string
+handling depends on the parameters being fit, so here we do it once per
+subject: `compile_trials` turns `sub_df` into integer arrays, and
+`neg_log_posterior` replays those arrays with the Q values held in small,
+fixed-shape NumPy arrays.
+
+Two things let the replay carry less state than `Agent` does:
+
+    1) Qmb is always equal to the planet Qs. Both start at .5, and every time a
+    planet's Q changes, `qmb_update` copies it into the Qmb of both rocket
+    pairs. So we only keep `Qtd` (rocket pair x planet) and `Qp` (planet).
+
+    2) Whether π and ρ get added into Qplus depends only on what happened on
+    the previous trial (which rocket pair, which sides, which planet), not on
+    any parameter. `compile_trials` works these out ahead of time as 0/1
+    indicators, `stay_bonus` and `side_bonus`, so that on each trial
+
+        Qplus = w * Qp + (1 - w) * Qtd[pair] + π * stay_bonus + ρ * side_bonus
+
+    (after a trial with no planet, i.e., "NA", `Agent` adds ρ to both planets'
+    Qplus; that cancels out of the softmax, so we leave it out).
+
+Incomplete trials don't touch the Q values or the likelihood, so once the
+indicators are worked out they get dropped.
+
+A single agent with two planets (i.e., every fit) goes through `replay_one`
+instead, which does the same thing with plain floats, since NumPy's overhead
+on arrays that small outweighs the arithmetic.
+
+`replay_one_timed` is the same again, but timing each phase of a trial, for
+when fits are being instrumented (see `instrument.py`).
+"""
+
+import numpy as np
+from collections import namedtuple
+from math import exp
+from simulate_and_model import STAKE_TYPES, log_prior_densities, prior_gradient, log_logistic
+
+
+CompiledTrials = namedtuple(
+    "CompiledTrials",
+    ("pair", "stake", "planet", "payoff", "stay_bonus", "side_bonus", "n_pairs")
+)
+
+
+def compile_trials(sub_df, rocket_pairs, pair_sides, planets):
+    return assemble_trials(*encode_trials(sub_df, rocket_pairs, pair_sides, planets),
+                           len(rocket_pairs), len(planets))
+
+
+def encode_trials(sub_df, rocket_pairs, pair_sides, planets):
+
+    # every trial of `sub_df`, completed or not, as plain arrays (these are
+    # also what `trial_store.py` saves for each subject)
+    return (
+        encode(sub_df.og_pair, rocket_pairs),
+        encode(sub_df.stake_type, STAKE_TYPES),
+        encode(sub_df.pair_sides, pair_sides),
+        encode(sub_df.preset_planet, planets),                                  # -1 wherever there's no planet (i.e., "NA")
+        sub_df.points.fillna(0).to_numpy(dtype=float),
+        sub_df.completed_trial.to_numpy(dtype=bool)
+    )
+
+
+def encode(column, levels):
+    codes = np.full(len(column), -1)
+
+    for index, level in enumerate(levels):
+        codes[(column == level).to_numpy()] = index
+
+    return codes
+
+
+def assemble_trials(pair, stake, side, planet, payoff, completed, n_pairs, n_planets, previous=(-1, -1, -1)):
+
+    # what happened on the trial before each trial. For the first trial,
+    # that's `previous` (the pair, side, and planet of the trial before, if
+    # these trials pick up where others left off); when there's nothing
+    # before, we mark it the same way as a trial with no planet
+    prev_pair, prev_side, prev_planet = (np.roll(arr, 1) for arr in (pair, side, planet))
+    if len(pair):
+        prev_pair[0], prev_side[0], prev_planet[0] = previous
+
+    went_there = prev_planet[:, None] == np.arange(n_planets)                   # one row per trial, one column per planet; True for the planet we landed on last trial
+    stay_bonus = went_there & (prev_pair == pair)[:, None]                      # π: same planet, reached from the same rocket pair we're looking at now
+    side_bonus = (went_there == (prev_side == side)[:, None]) & (prev_planet >= 0)[:, None]    # ρ: see the second `if` in `RocketPairObj.q_integrate`
+
+    return CompiledTrials(
+        pair[completed],
+        stake[completed],
+        planet[completed],
+        payoff[completed],
+        stay_bonus[completed].astype(float),
+        side_bonus[completed].astype(float),
+        n_pairs
+    )
+
+
+ReplayState = namedtuple("ReplayState", ("Qtd", "Qp", "dQtd", "dQp"))          # agents first on every array; the sensitivities are None without a gradient
+Replay = namedtuple("Replay", ("log_lik", "d_log_lik", "state", "log_p"))
+
+
+def neg_log_posterior(params, trials, include_priors, gradient=False, priors=None):
+
+    if gradient:
+        aposteriori, grad = batch_neg_log_posterior(np.asarray(params)[None, :], trials, include_priors, True, priors)
+        return aposteriori[0], grad[0]
+
+    return batch_neg_log_posterior(np.asarray(params)[None, :], trials, include_priors, priors=priors)[0]
+
+
+def batch_neg_log_posterior(param_sets, trials, include_priors, gradient=False, priors=None):
+
+    # `param_sets` has one row per parameter vector (same column order as
+    # `params` in `mle`); every row gets its own agent, and all of them step
+    # through the trials together (see `replay`). `priors` is only needed if
+    # we don't want the usual ones (`DEFAULT_PRIORS` in
+    # `simulate_and_model.py`)
+    param_sets = np.asarray(param_sets, dtype=float)
+    log_lik, d_log_lik, _, _ = replay(param_sets, trials, gradient)
+
+    aposteriori = -log_lik
+
+    if include_priors:
+        aposteriori -= np.sum(log_prior_densities(param_sets.T, priors), axis=0)   # the log densities take a whole column of a parameter at a time
+
+    if not gradient:
+        return aposteriori
+
+    if include_priors:
+        d_log_lik += np.array(prior_gradient(param_sets.T, priors)).T
+
+    return aposteriori, -d_log_lik
+
+
+def replay(param_sets, trials, gradient=False, start=None, keep_trials=False):
+
+    # steps one agent per row of `param_sets` through `trials`, with each line
+    # inside the loop working on all of the agents at once. Agents start out
+    # with every Q at .5, or from the Q values (and, with `gradient`, their
+    # sensitivities) in `start`, a `ReplayState` left over from an earlier
+    # replay; that's how `online.py` picks up where the last batch of trials
+    # left off. Hands back the summed log likelihood, its gradient (with
+    # `gradient`), the agents' state after the last trial, and (with
+    # `keep_trials`) the log probability of each trial's choice
+    if len(param_sets) == 1 and trials.stay_bonus.shape[1] == 2 and start is None:
+        return replay_one(param_sets[0], trials, gradient, keep_trials)
+
+    α, β, λ, π, ρ = param_sets[:, 0:5].T
+    ws = param_sets[:, 5:]
+
+    w = ws[:, trials.stake].T[:, :, None]                                      # trials x agents x 1, so it broadcasts over planets
+    bonus = (trials.stay_bonus[:, None, :] * π[:, None] +
+             trials.side_bonus[:, None, :] * ρ[:, None])                        # trials x agents x planets
+
+    n_agents, n_params = param_sets.shape
+    n_planets = trials.stay_bonus.shape[1]
+    binary = n_planets == 2                                                     # the task as it stands; see the closed form below
+
+    if start is None:
+        Qtd = np.full((n_agents, trials.n_pairs, n_planets), .5)
+        Qp = np.full((n_agents, n_planets), .5)
+    else:
+        Qtd, Qp = start.Qtd.copy(), start.Qp.copy()
+
+    log_lik = np.zeros(n_agents)                                                # running sum of the log of `p_choice`
+    log_p = np.empty((len(trials.pair), n_agents)) if keep_trials else None
+    dQtd = dQp = d_log_lik = None
+
+    if gradient:
+        # forward-mode sensitivities: alongside every Q value we carry its
+        # derivative with respect to each of the parameters (last axis), and
+        # push those derivatives through the same steps as the Q values
+        dQtd = np.zeros(Qtd.shape + (n_params,)) if start is None else start.dQtd.copy()
+        dQp = np.zeros(Qp.shape + (n_params,)) if start is None else start.dQp.copy()
+        d_log_lik = np.zeros((n_agents, n_params))
+
+    for t, (pair, stake, planet, payoff) in enumerate(zip(trials.pair.tolist(),
+                                                          trials.stake.tolist(),
+                                                          trials.planet.tolist(),
+                                                          trials.payoff.tolist())):
+
+        # `RocketPairObj.q_integrate` and `Agent.planet_selection`
+        qplus = Qp * w[t] + Qtd[:, pair] * (1 - w[t]) + bonus[t]
+        choice_value = qplus * β[:, None]
+
+        if binary:
+            # with two planets the softmax is a logistic of the difference
+            # between their choice values, so the chosen planet's log
+            # probability is -log(1 + exp(-margin))
+            margin = choice_value[:, planet] - choice_value[:, 1 - planet]
+            log_p_choice = -np.logaddexp(0, -margin)
+        else:
+            # softmax in log space: taking the biggest choice value off all of
+            # them first leaves the probabilities the same, but keeps `np.exp`
+            # from overflowing when β and Qplus are large, and the chosen
+            # planet's log probability comes out directly instead of as the
+            # log of a probability that may have underflowed to 0
+            choice_value -= choice_value.max(axis=1, keepdims=True)
+            weighted_choices = np.exp(choice_value)
+            total = weighted_choices.sum(axis=1)
+            weighted_choices /= total[:, None]
+            log_p_choice = choice_value[:, planet] - np.log(total)
+
+        log_lik += log_p_choice
+        if keep_trials:
+            log_p[t] = log_p_choice
+
+        # `Agent.q_update` (the Qmb update comes for free, since Qmb is just Qp)
+        rpe1 = Qp[:, planet] - Qtd[:, pair, planet]
+        rpe2 = payoff - Qp[:, planet]
+
+        if gradient:
+            d_qplus = dQp * w[t][:, :, None] + dQtd[:, pair] * (1 - w[t])[:, :, None]
+            d_qplus[:, :, 5 + stake] += Qp - Qtd[:, pair]                      # the w for this trial's stake
+            d_qplus[:, :, 3] += trials.stay_bonus[t]
+            d_qplus[:, :, 4] += trials.side_bonus[t]
+
+            d_choice_value = d_qplus * β[:, None, None]                        # derivative of β * Qplus
+            d_choice_value[:, :, 1] += qplus
+
+            # d log(softmax of the chosen planet) = d(chosen) - softmax-weighted average of d(all),
+            # which for two planets is the probability of the other planet times d(chosen - other)
+            if binary:
+                p_other = np.exp(-np.logaddexp(0, margin))
+                d_log_lik += p_other[:, None] * (d_choice_value[:, planet] - d_choice_value[:, 1 - planet])
+            else:
+                d_log_lik += d_choice_value[:, planet] - (weighted_choices[:, :, None] * d_choice_value).sum(axis=1)
+
+            d_rpe1 = dQp[:, planet] - dQtd[:, pair, planet]
+            d_rpe2 = -dQp[:, planet]
+
+            dQtd[:, pair, planet] += (d_rpe1 + d_rpe2 * λ[:, None]) * α[:, None]
+            dQtd[:, pair, planet, 0] += rpe1 + rpe2 * λ
+            dQtd[:, pair, planet, 2] += rpe2 * α
+            dQp[:, planet] += d_rpe2 * α[:, None]
+            dQp[:, planet, 0] += rpe2
+
+        Qtd[:, pair, planet] += rpe1 * α
+        Qp[:, planet] += rpe2 * α
+        Qtd[:, pair, planet] += rpe2 * α * λ
+
+    return Replay(log_lik, d_log_lik, ReplayState(Qtd, Qp, dQtd, dQp), log_p)
+
+
+def replay_one(params, trials, gradient=False, keep_trials=False):
+
+    # `replay` for one agent and two planets, in plain floats. The Q values
+    # only depend on α and λ (Qp on α alone), so those are the only
+    # sensitivities worth carrying; every other parameter only enters through
+    # the choice on each trial
+    α, β, λ, π, ρ = params[0:5].tolist()
+    ws = params[5:].tolist()
+
+    Qtd = [[.5, .5] for _ in range(trials.n_pairs)]
+    Qp = [.5, .5]
+    dQtd_α = [[0., 0.] for _ in range(trials.n_pairs)]
+    dQtd_λ = [[0., 0.] for _ in range(trials.n_pairs)]
+    dQp_α = [0., 0.]
+
+    log_lik = 0.
+    d_log_lik = [0.] * len(params)
+    log_p = []
+
+    for pair, stake, planet, payoff, stay_bonus, side_bonus in zip(trials.pair.tolist(), trials.stake.tolist(),
+                                                                    trials.planet.tolist(), trials.payoff.tolist(),
+                                                                    trials.stay_bonus.tolist(),
+                                                                    trials.side_bonus.tolist()):
+        other = 1 - planet
+        w = ws[stake]
+        td, td_α, td_λ = Qtd[pair], dQtd_α[pair], dQtd_λ[pair]
+
+        # `RocketPairObj.q_integrate` and `Agent.planet_selection`, for the
+        # difference between the chosen planet and the other one
+        difference = ((Qp[planet] - Qp[other]) * w + (td[planet] - td[other]) * (1 - w) +
+                      (stay_bonus[planet] - stay_bonus[other]) * π + (side_bonus[planet] - side_bonus[other]) * ρ)
+        margin = β * difference
+        log_p_choice = log_logistic(margin)
+
+        log_lik += log_p_choice
+        if keep_trials:
+            log_p.append(log_p_choice)
+
+        if gradient:
+            p_other = exp(log_logistic(-margin))
+            slope = p_other * β                                                 # d log p / d difference
+
+            d_log_lik[0] += slope * ((dQp_α[planet] - dQp_α[other]) * w + (td_α[planet] - td_α[other]) * (1 - w))
+            d_log_lik[1] += p_other * difference
+            d_log_lik[2] += slope * (td_λ[planet] - td_λ[other]) * (1 - w)
+            d_log_lik[3] += slope * (stay_bonus[planet] - stay_bonus[other])
+            d_log_lik[4] += slope * (side_bonus[planet] - side_bonus[other])
+            d_log_lik[5 + stake] += slope * ((Qp[planet] - td[planet]) - (Qp[other] - td[other]))
+
+        # `Agent.q_update`
+        rpe1 = Qp[planet] - td[planet]
+        rpe2 = payoff - Qp[planet]
+
+        if gradient:
+            d_rpe1_α = dQp_α[planet] - td_α[planet]
+            d_rpe2_α = -dQp_α[planet]
+
+            td_α[planet] += (d_rpe1_α + d_rpe2_α * λ) * α + rpe1 + rpe2 * λ
+            td_λ[planet] += -td_λ[planet] * α + rpe2 * α                        # Qp doesn't depend on λ
+            dQp_α[planet] += d_rpe2_α * α + rpe2
+
+        td[planet] += rpe1 * α + rpe2 * α * λ
+        Qp[planet] += rpe2 * α
+
+    dQtd = dQp = None
+    if gradient:
+        dQtd = np.zeros((1, trials.n_pairs, 2, len(params)))
+        dQtd[0, :, :, 0], dQtd[0, :, :, 2] = dQtd_α, dQtd_λ
+        dQp = np.zeros((1, 2, len(params)))
+        dQp[0, :, 0] = dQp_α
+
+    return Replay(np.array([log_lik]), np.array([d_log_lik]) if gradient else None,
+                  ReplayState(np.array([Qtd]), np.array([Qp]), dQtd, dQp),
+                  np.array(log_p)[:, None] if keep_trials else None)
+
+
+def replay_one_timed(lap, params, trials, gradient=False, keep_trials=False):
+
+    # `replay_one`, but calling `lap` with each phase's name as the phase
+    # ends; `Instruments` swaps it in for `replay_one` (see `instrument.py`).
+    # It's a copy rather than checks inside `replay_one`, so that fits that
+    # aren't being timed don't pay for them on every trial
+    α, β, λ, π, ρ = params[0:5].tolist()
+    ws = params[5:].tolist()
+
+    Qtd = [[.5, .5] for _ in range(trials.n_pairs)]
+    Qp = [.5, .5]
+    dQtd_α = [[0., 0.] for _ in range(trials.n_pairs)]
+    dQtd_λ = [[0., 0.] for _ in range(trials.n_pairs)]
+    dQp_α = [0., 0.]
+
+    log_lik = 0.
+    d_log_lik = [0.] * len(params)
+    log_p = []
+
+    for pair, stake, planet, payoff, stay_bonus, side_bonus in zip(trials.pair.tolist(), trials.stake.tolist(),
+                                                                    trials.planet.tolist(), trials.payoff.tolist(),
+                                                                    trials.stay_bonus.tolist(),
+                                                                    trials.side_bonus.tolist()):
+        other = 1 - planet
+        w = ws[stake]
+        td, td_α, td_λ = Qtd[pair], dQtd_α[pair], dQtd_λ[pair]
+
+        # `RocketPairObj.q_integrate` and `Agent.planet_selection`, for the
+        # difference between the chosen planet and the other one
+        difference = ((Qp[planet] - Qp[other]) * w + (td[planet] - td[other]) * (1 - w) +
+                      (stay_bonus[planet] - stay_bonus[other]) * π + (side_bonus[planet] - side_bonus[other]) * ρ)
+        lap("q_integrate")
+
+        margin = β * difference
+        log_p_choice = log_logistic(margin)
+
+        log_lik += log_p_choice
+        if keep_trials:
+            log_p.append(log_p_choice)
+        lap("planet_selection")
+
+        # `Agent.q_update`
+        rpe1 = Qp[planet] - td[planet]
+        rpe2 = payoff - Qp[planet]
+
+        if gradient:
+            p_other = exp(log_logistic(-margin))
+            slope = p_other * β                                                 # d log p / d difference
+
+            d_log_lik[0] += slope * ((dQp_α[planet] - dQp_α[other]) * w + (td_α[planet] - td_α[other]) * (1 - w))
+            d_log_lik[1] += p_other * difference
+            d_log_lik[2] += slope * (td_λ[planet] - td_λ[other]) * (1 - w)
+            d_log_lik[3] += slope * (stay_bonus[planet] - stay_bonus[other])
+            d_log_lik[4] += slope * (side_bonus[planet] - side_bonus[other])
+            d_log_lik[5 + stake] += slope * ((Qp[planet] - td[planet]) - (Qp[other] - td[other]))
+
+            d_rpe1_α = dQp_α[planet] - td_α[planet]
+            d_rpe2_α = -dQp_α[planet]
+
+            td_α[planet] += (d_rpe1_α + d_rpe2_α * λ) * α + rpe1 + rpe2 * λ
+            td_λ[planet] += -td_λ[planet] * α + rpe2 * α                        # Qp doesn't depend on λ
+            dQp_α[planet] += d_rpe2_α * α + rpe2
+            lap("gradient")
+
+        td[planet] += rpe1 * α + rpe2 * α * λ
+        Qp[planet] += rpe2 * α
+        lap("q_update")
+
+    dQtd = dQp = None
+    if gradient:
+        dQtd = np.zeros((1, trials.n_pairs, 2, len(params)))
+        dQtd[0, :, :, 0], dQtd[0, :, :, 2] = dQtd_α, dQtd_λ
+        dQp = np.zeros((1, 2, len(params)))
+        dQp[0, :, 0] = dQp_α
+
+    return Replay(np.array([log_lik]), np.array([d_log_lik]) if gradient else None,
+                  ReplayState(np.array([Qtd]), np.array([Qp]), dQtd, dQp),
+                  np.array(log_p)[:, None] if keep_trials else None)
+
+
+def finite_difference_hessian(gradient_rows, x, bounds, step=1e-4):
+
+    # central differences of an analytic gradient, one parameter at a time;
+    # `gradient_rows` takes a matrix of parameter vectors and returns the
+    # gradient at each row, so all 2 x 9 shifted vectors go through the trials
+    # in one batch. Shifts that would leave the bounds get clipped back onto
+    # them
+    lb, ub = np.array(bounds, dtype=float).T
+    shifts = np.diag(step * (ub - lb))
+
+    above = np.minimum(x + shifts, ub)
+    below = np.maximum(x - shifts, lb)
+
+    grad_above, grad_below = np.split(gradient_rows(np.vstack([above, below])), 2)
+
+    hessian = (grad_above - grad_below).T / np.diag(above - below)
+    return (hessian + hessian.T) / 2
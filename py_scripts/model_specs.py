@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fits a whole family of nested versions of the model to each subject in one
+go, and compares them, rather than running each version as its own set of
+array jobs.
+
+    python model_specs.py [TASK_ID SUBJECTS_PER_TASK]
+
+A `ModelSpec` says what happens to each of the nine parameters: left free
+(the default), fixed at a value (e.g., `λ=1.`), or tied to other parameters
+under a shared name (e.g., all four ws as `"w"`). Behind the scenes that's a
+linear map from the spec's free parameters `z` to the full set, `A @ z +
+fixed`, so the likelihood engine (`likelihood.py`) runs unchanged and the
+gradient with respect to `z` is just `A.T` times the full gradient.
+
+For each subject, the trials get loaded once and every spec in `SPECS` gets
+fit by maximum likelihood (without priors, whatever the manifest says, since
+AIC, BIC, and the likelihood-ratio tests all assume the fit maximizes the
+likelihood) in order, the full model first (from the subject's best fit so far in
+`fit_results`, if there is one). Each fit starts from whichever of the optima
+found so far (or that first start) does best once squeezed into that spec's
+constraints; all of those candidates get scored in a single batched replay.
+`fit_spec` can include priors for other uses, in which case fixed parameters
+don't get one, since they aren't being estimated.
+
+Each subject gets a row per spec, with the number of free parameters, the
+log likelihood at the fit (without priors), AIC, and BIC, and a row for every
+pair of specs where one is nested inside the other, with the likelihood-ratio
+statistic and its chi-squared p-value (which is only approximate when the
+restriction puts a parameter on the edge of its bounds, like λ=1). A negative
+statistic means the bigger model's fit stopped short of its optimum. They go to
+`model_comparison/fits-<TASK_ID>.csv` and `model_comparison/lrt-<TASK_ID>.csv`
+in the experiment's folder.
+"""
+
+from sys import argv
+from os import path, makedirs
+from itertools import permutations
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.stats import chi2
+from simulate_and_model import log_prior_densities, prior_gradient
+from wrapper import PARAM_NAMES, load_trials
+from likelihood import replay
+
+
+class ModelSpec:
+
+    def __init__(self, name, **constraints):
+
+        # `constraints` maps parameters to a number (fixed at that value) or a
+        # name (tied to every other parameter given the same name); any
+        # parameter left out is free
+        self.name = name
+        self.fixed = np.zeros(len(PARAM_NAMES))
+        self.estimated = np.ones(len(PARAM_NAMES), dtype=bool)
+        columns = {}
+
+        for index, param in enumerate(PARAM_NAMES):
+            constraint = constraints.get(param, param)
+            if isinstance(constraint, str):
+                columns.setdefault(constraint, []).append(index)
+            else:
+                self.fixed[index] = constraint
+                self.estimated[index] = False
+
+        self.free = list(columns)
+        self.A = np.zeros((len(PARAM_NAMES), len(columns)))
+        for column, indices in enumerate(columns.values()):
+            self.A[indices, column] = 1
+
+    def expand(self, z):
+        return z @ self.A.T + self.fixed                                        # works on one z or a matrix of them, one per row
+
+    def bounds(self, bounds):
+        lb, ub = np.array(bounds, dtype=float).T
+        return [(lb[self.A[:, column] == 1].max(), ub[self.A[:, column] == 1].min()) for column in range(len(self.free))]
+
+    def project(self, params, bounds):
+
+        # the closest point this spec can reach: the average of the
+        # parameters that get tied together, kept within bounds
+        z = (params @ self.A) / self.A.sum(axis=0)
+        lb, ub = np.array(self.bounds(bounds)).T
+        return np.clip(z, lb, ub)
+
+    def nested_in(self, other):
+
+        # True if every set of parameters this spec can reach, `other` can too
+        # (e.g., one shared w is nested in four separate ws)
+        reach, *_ = np.linalg.lstsq(other.A, np.column_stack([self.A, self.fixed - other.fixed]), rcond=None)
+        return np.allclose(other.A @ reach, np.column_stack([self.A, self.fixed - other.fixed]))
+
+
+SPECS = (
+    ModelSpec("full"),
+    ModelSpec("shared_w", w_high="w", w_faux_high="w", w_faux_low="w", w_low="w"),
+    ModelSpec("λ=1", λ=1.),
+    ModelSpec("π=0", π=0.),
+    ModelSpec("ρ=0", ρ=0.),
+    ModelSpec("π=ρ=0", π=0., ρ=0.)
+)
+
+
+def spec_neg_log_posterior(param_sets, trials, spec, include_priors, gradient=False, priors=None):
+
+    # like `batch_neg_log_posterior`, but without priors on parameters the
+    # spec fixes, and with the negative log likelihood on its own as well
+    log_lik, d_log_lik, _, _ = replay(param_sets, trials, gradient)
+    aposteriori = -log_lik
+
+    if include_priors:
+        aposteriori -= np.sum(np.array(log_prior_densities(param_sets.T, priors))[spec.estimated], axis=0)
+
+    if not gradient:
+        return aposteriori, -log_lik
+
+    d_aposteriori = -d_log_lik
+    if include_priors:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slopes = np.array(prior_gradient(param_sets.T, priors)).T
+        d_aposteriori -= np.where(spec.estimated, slopes, 0)                    # a fixed parameter can sit where its prior's slope is infinite (e.g., λ=1), and inf * 0 would be NaN
+
+    return aposteriori, -log_lik, d_aposteriori
+
+
+def fit_spec(trials, spec, bounds, include_priors, z0, priors=None):
+
+    def objective(z):
+        aposteriori, _, d_aposteriori = spec_neg_log_posterior(spec.expand(z)[None, :], trials, spec,
+                                                                include_priors, True, priors)
+        return aposteriori[0], d_aposteriori[0] @ spec.A                        # chain rule through `expand`
+
+    return minimize(
+        objective,
+        z0,
+        jac=True,
+        method='L-BFGS-B',
+        bounds=spec.bounds(bounds)
+    )
+
+
+def fit_family(trials, bounds, x0, specs=SPECS):
+
+    fitted = [np.asarray(x0, dtype=float)]                                      # full parameter vectors each new fit could start from
+    rows = []
+
+    for spec in specs:
+        candidates = np.array([spec.project(params, bounds) for params in fitted])
+        scores, _ = spec_neg_log_posterior(spec.expand(candidates), trials, spec, False)
+
+        fit = fit_spec(trials, spec, bounds, False, candidates[np.argmin(scores)])
+        params = spec.expand(fit.x)
+        fitted.append(params)
+
+        k, n = len(spec.free), len(trials.pair)
+
+        rows.append({"model": spec.name, "k": k, "trials": n, "log_lik": -fit.fun,
+                     "aic": 2 * k + 2 * fit.fun, "bic": k * np.log(n) + 2 * fit.fun,
+                     "fun": fit.fun, "nfev": fit.nfev, "success": fit.success,
+                     **dict(zip(PARAM_NAMES, params))})
+
+    return pd.DataFrame(rows)
+
+
+def likelihood_ratio_tests(fits, specs=SPECS):
+    by_name = fits.set_index("model")
+    tests = []
+
+    for restricted, general in permutations(specs, 2):
+        if restricted.nested_in(general) and len(restricted.free) < len(general.free):
+            statistic = 2 * (by_name.loc[general.name, "log_lik"] - by_name.loc[restricted.name, "log_lik"])
+            df = len(general.free) - len(restricted.free)
+            tests.append({"restricted": restricted.name, "general": general.name,
+                          "statistic": statistic, "df": df, "p": chi2.sf(statistic, df)})
+
+    return pd.DataFrame(tests)
+
+
+if __name__ == '__main__':
+    from run_wrapper import data_dir, experiment_dir, results_dir
+    from results_store import best_fits
+    from job_manifest import MANIFEST_NAME, open_manifest, job_params
+    from fit_cache import bounds_of, start_of
+
+    manifest = open_manifest(path.join(experiment_dir, MANIFEST_NAME))
+    first_rows = {}
+    for index, sub_path in enumerate(manifest["sub_path"].tolist()):
+        first_rows.setdefault(sub_path, index)
+
+    task_id = int(argv[1]) if len(argv) > 2 else 0
+    subjects = list(first_rows)
+    if len(argv) > 2:
+        subjects = subjects[(task_id - 1) * int(argv[2]):task_id * int(argv[2])]
+
+    best = best_fits(results_dir).set_index("subject")
+    all_fits, all_tests = [], []
+
+    for sub_path in subjects:
+        params = job_params(manifest, first_rows[sub_path])
+        subject = path.splitext(sub_path)[0]
+        x0 = best.loc[subject, list(PARAM_NAMES)].to_numpy(dtype=float) if subject in best.index else start_of(params)
+
+        trials = load_trials(data_directory=data_dir, sub_path=sub_path)
+        fits = fit_family(trials, bounds_of(params), x0)
+
+        all_fits.append(fits.assign(subject=subject))
+        all_tests.append(likelihood_ratio_tests(fits).assign(subject=subject))
+
+    out_dir = path.join(experiment_dir, "model_comparison")
+    makedirs(out_dir, exist_ok=True)
+    pd.concat(all_fits).to_csv(path.join(out_dir, f"fits-{task_id}.csv"), index=False)
+    pd.concat(all_tests).to_csv(path.join(out_dir, f"lrt-{task_id}.csv"), index=False)
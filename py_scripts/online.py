@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Keeps one subject's model up to date as their trials come in, so we can keep
+an eye on participants while data is still being collected, without
+re-splicing and refitting everything from scratch.
+
+    online = start_online(x=fit.x, bounds=bounds, sub_df=sub_df)   # e.g., the trials so far and their fit
+    update = online.push(new_trials)                              # each new trial's choice probability under the current fit
+    online.q_values                                               # and the Q values after the last trial
+    fit = online.refit()                                          # a fresh fit that takes the new trials into account
+    saved = online.to_bytes()                                     # ... and later, `OnlineFit.from_bytes(saved)`
+
+`new_trials` are rows in the same format as the spliced csvs (`og_pair`,
+`stake_type`, `pair_sides`, `preset_planet`, `completed_trial`, `points`, and
+`trial_index`), so rows from `Raw_Data.csv` need the same conversion that
+`splice_raw` does first.
+
+Refitting only replays the trials pushed since the last refit. Everything
+before those is boiled down to the agent's state where they left off (its Q
+values, and how they change with each parameter) and a quadratic in the
+parameters for the negative log likelihood of those earlier trials, both taken
+around the last fit's parameters, `x`. For parameters near `x`, the new trials
+start from that state moved along its sensitivities, and the earlier trials
+count through the quadratic; that's exact at `x` and a second-order
+approximation around it, so for a final fit of a subject's data it's still
+worth going through `wrapper.model` once collection is done. Every refit
+starts from the previous fit, and then folds the new trials into the state
+and the quadratic around the new optimum.
+"""
+
+import json
+from io import BytesIO
+import numpy as np
+from scipy.optimize import minimize
+from simulate_and_model import log_prior_densities, prior_gradient
+from wrapper import extract_key_variables
+from likelihood import (ReplayState, encode_trials, assemble_trials, replay,
+                        finite_difference_hessian)
+
+
+@extract_key_variables
+def start_online(rocket_pairs, pair_sides, planets, x, bounds, include_priors=True, priors=None, sub_df=None):
+
+    # `sub_df`, if given, is the trials so far, which get pushed and folded in
+    # around `x` (usually their fit) right away
+    online = OnlineFit(rocket_pairs, pair_sides, planets, x, bounds, include_priors, priors)
+
+    if sub_df is not None:
+        online.push(sub_df)
+        online.absorb(online.x)
+
+    return online
+
+
+class OnlineFit:
+
+    def __init__(self, rocket_pairs, pair_sides, planets, x, bounds, include_priors=True, priors=None):
+        self.rocket_pairs, self.pair_sides, self.planets = list(rocket_pairs), list(pair_sides), list(planets)
+        self.x = np.asarray(x, dtype=float)
+        self.bounds = [tuple(bound) for bound in bounds]
+        self.include_priors = include_priors
+        self.priors = priors
+
+        n_params = len(self.x)
+        shape = (1, len(self.rocket_pairs), len(self.planets))
+
+        # the trials folded in so far: the negative log likelihood as a
+        # quadratic around `x`, and the agent's state after the last of them
+        self.prefix_fun, self.prefix_grad, self.prefix_hess = 0., np.zeros(n_params), np.zeros((n_params, n_params))
+        self.anchor = ReplayState(np.full(shape, .5), np.full(shape[::2], .5),
+                                  np.zeros(shape + (n_params,)), np.zeros(shape[::2] + (n_params,)))
+        self.anchor_previous = (-1, -1, -1)                                     # pair, side, and planet of the last trial folded in
+
+        # the trials pushed since (as encoded by `encode_trials`), and the
+        # agent's state at `x` after the last of those
+        self.pending = tuple(np.empty(0, dtype=dtype) for dtype in (int, int, int, int, float, bool))
+        self.state, self.previous = self.anchor, self.anchor_previous
+
+    def push(self, sub_df):
+        arrays = encode_trials(sub_df, self.rocket_pairs, self.pair_sides, self.planets)
+        trials = assemble_trials(*arrays, len(self.rocket_pairs), len(self.planets), self.previous)
+
+        result = replay(self.x[None, :], trials, True, self.state, keep_trials=True)
+
+        self.state = result.state
+        self.pending = tuple(np.concatenate([old, new]) for old, new in zip(self.pending, arrays))
+        if len(arrays[0]):
+            self.previous = (arrays[0][-1], arrays[2][-1], arrays[3][-1])
+
+        completed = arrays[5]
+        return sub_df.loc[completed, ["trial_index", "preset_planet"]].assign(p_choice=np.exp(result.log_p[:, 0]))
+
+    @property
+    def q_values(self):
+        q_values = {}
+        for pair_index, pair in enumerate(self.rocket_pairs):
+            for planet_index, planet in enumerate(self.planets):
+                q_values['Qtd(' + pair + ',' + planet + ')'] = self.state.Qtd[0, pair_index, planet_index]
+        for planet_index, planet in enumerate(self.planets):
+            q_values['Q(' + planet + ')'] = self.state.Qp[0, planet_index]     # also every rocket pair's Qmb
+        return q_values
+
+    def neg_log_lik(self, param_sets, gradient=False):
+
+        # for every row of `param_sets`: the quadratic for the trials folded
+        # in, plus a replay of the pending trials starting from the anchor's
+        # state moved along its sensitivities to that row's parameters
+        offsets = param_sets - self.x
+        start = ReplayState(
+            self.anchor.Qtd + np.einsum("ijk,nk->nij", self.anchor.dQtd[0], offsets),
+            self.anchor.Qp + np.einsum("ik,nk->ni", self.anchor.dQp[0], offsets),
+            np.broadcast_to(self.anchor.dQtd, (len(offsets),) + self.anchor.dQtd.shape[1:]),
+            np.broadcast_to(self.anchor.dQp, (len(offsets),) + self.anchor.dQp.shape[1:])
+        )
+
+        trials = assemble_trials(*self.pending, len(self.rocket_pairs), len(self.planets), self.anchor_previous)
+        result = replay(param_sets, trials, gradient, start)
+
+        fun = (self.prefix_fun + offsets @ self.prefix_grad +
+               .5 * np.einsum("ni,ij,nj->n", offsets, self.prefix_hess, offsets) - result.log_lik)
+        grad = self.prefix_grad + offsets @ self.prefix_hess - result.d_log_lik if gradient else None
+
+        return fun, grad, result.state
+
+    def neg_log_posterior(self, params):
+        fun, grad, _ = self.neg_log_lik(np.asarray(params, dtype=float)[None, :], True)
+        fun, grad = fun[0], grad[0]
+
+        if self.include_priors:
+            fun -= np.sum(log_prior_densities(params, self.priors))
+            grad -= np.array(prior_gradient(params, self.priors))
+
+        return fun, grad
+
+    def refit(self):
+        fit = minimize(
+            self.neg_log_posterior,
+            self.x,                                                             # warm start from the last fit
+            jac=True,
+            method='L-BFGS-B',
+            bounds=self.bounds
+        )
+
+        self.absorb(fit.x)
+        return fit
+
+    def absorb(self, x):
+
+        # folds the pending trials into the quadratic and the anchor, around `x`
+        x = np.asarray(x, dtype=float)
+
+        hessian = finite_difference_hessian(lambda param_sets: self.neg_log_lik(param_sets, True)[1], x, self.bounds)
+        eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+        hessian = eigenvectors @ np.diag(np.maximum(eigenvalues, 0)) @ eigenvectors.T   # a quadratic that curves downward anywhere would send the optimizer off to the bounds
+
+        fun, grad, state = self.neg_log_lik(x[None, :], True)
+
+        self.prefix_fun, self.prefix_grad, self.prefix_hess = fun[0], grad[0], hessian
+        self.anchor, self.anchor_previous = state, self.previous
+        self.x = x
+        self.pending = tuple(arr[:0] for arr in self.pending)
+        self.state = self.anchor
+
+    def to_bytes(self):
+        settings = {"rocket_pairs": self.rocket_pairs, "pair_sides": self.pair_sides, "planets": self.planets,
+                    "bounds": self.bounds, "include_priors": bool(self.include_priors),
+                    "priors": None if self.priors is None else [(family, float(a), float(b)) for family, a, b in self.priors],
+                    "anchor_previous": [int(value) for value in self.anchor_previous],
+                    "previous": [int(value) for value in self.previous]}
+
+        buffer = BytesIO()
+        np.savez_compressed(
+            buffer,
+            settings=np.array(json.dumps(settings)),
+            x=self.x, prefix_fun=np.array(self.prefix_fun), prefix_grad=self.prefix_grad, prefix_hess=self.prefix_hess,
+            **{"anchor_" + name: value for name, value in self.anchor._asdict().items()},
+            **{"state_" + name: value for name, value in self.state._asdict().items()},
+            **{"pending_" + str(index): value for index, value in enumerate(self.pending)}
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, saved):
+        with np.load(BytesIO(saved)) as npz:
+            settings = json.loads(str(npz["settings"]))
+            priors = None if settings["priors"] is None else tuple(tuple(prior) for prior in settings["priors"])
+
+            online = cls(settings["rocket_pairs"], settings["pair_sides"], settings["planets"], npz["x"],
+                         settings["bounds"], settings["include_priors"], priors)
+
+            online.prefix_fun, online.prefix_grad, online.prefix_hess = (
+                float(npz["prefix_fun"]), npz["prefix_grad"], npz["prefix_hess"])
+            online.anchor = ReplayState(*(npz["anchor_" + name] for name in ReplayState._fields))
+            online.state = ReplayState(*(npz["state_" + name] for name in ReplayState._fields))
+            online.pending = tuple(npz["pending_" + str(index)] for index in range(len(online.pending)))
+            online.anchor_previous, online.previous = tuple(settings["anchor_previous"]), tuple(settings["previous"])
+
+        return online
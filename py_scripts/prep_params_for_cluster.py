@@ -3,21 +3,30 @@
 
 import sys
 import numpy as np
-import pandas as pd
-from siuba import _, filter, mutate, if_else, case_when, group_by, ungroup, select
-from wrapper import extract_key_variables
+from wrapper import PARAM_NAMES, extract_key_variables, load_trials
 from run_wrapper import _thisDir, data_dir
+from trial_store import STORE_NAME, build_trial_store
+from fit_cache import FitCache, trial_hash, config_hash
+from job_manifest import MANIFEST_NAME, write_manifest, open_manifest
+from run_state import RunState
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 
 @extract_key_variables
-def splice_raw(rocket_pairs, pair_sides, planets):
+def splice_raw(rocket_pairs, pair_sides, planets, data_directory=data_dir, experiment=None):
+
+    import pandas as pd                                                        # only needed for splicing, so they stay out of everything that imports this file for the rest
+    from siuba import _, filter, mutate, if_else, case_when
+
+    experiment = experiment or sys.argv[2]                                      # e.g., "second_go"; decides the neutral stake and how many completed trials a subject needs
 
     # remove any files currently in the directory, since we will ultimately model every file left in the directory
-    [f.unlink() for f in Path(os.path.join(data_dir, "Spliced")).glob("*") if f.is_file()]
+    [f.unlink() for f in Path(os.path.join(data_directory, "Spliced")).glob("*") if f.is_file()]
+    [f.unlink() for f in Path(data_directory).glob(STORE_NAME)]                 # along with the packed copy of those files, which gets rebuilt at the end
 
-    all_raw = pd.read_csv(os.path.join(data_dir, "Raw_Data.csv"))
+    all_raw = pd.read_csv(os.path.join(data_directory, "Raw_Data.csv"))
 
     all_mutated = (all_raw
       >> filter(_.practice == 0)
@@ -37,72 +46,72 @@ def splice_raw(rocket_pairs, pair_sides, planets):
          )
       )
 
-    all_subs = all_mutated.assignment_id.unique()
+    neutral_stake = 1 if experiment == "first_go" else 3
+    min_completed = {"first_go": 240, "second_go": 213}.get(experiment, np.inf)  # filter out participants with a lot of no responses
 
-    for sub_id in all_subs:
+    # stake groups for every subject at once, grouping by subject as well as
+    # by state1, rather than filtering the whole table down to one subject at
+    # a time
+    stake_mean = all_mutated.groupby(["assignment_id", "state1"])["stake"].transform("mean")
+    stake_group = np.where(stake_mean > neutral_stake, "high", "low").astype(object)
+    all_mutated = all_mutated.assign(stake_type=np.where(all_mutated.stake == neutral_stake, "faux_" + stake_group, stake_group))
 
-        neutral_stake = 1 if sys.argv[2] == "first_go" else 3
+    completed_per_sub = all_mutated.groupby("assignment_id")["completed_trial"].transform("sum")
 
-        sub_df = (all_mutated
-          >> filter(_.assignment_id == sub_id)
-          >> group_by("state1")
-          >> mutate(
-               stake_mean = _.stake.mean(),
-               stake_group = if_else(_.stake_mean > neutral_stake, "high", "low"),
-               stake_type = if_else(_.stake == neutral_stake, "faux_" + _.stake_group, _.stake_group)
-             )
-          >> ungroup()
-          # to keep this code consistent with my r code, i could set trial_index column equal to actual row number, now that practice trials have been filtered; not a biggie, though
-          >> select(
-               _.trial_index,
-               _.og_pair,
-               _.stake_type,
-               _.pair_sides,
-               _.preset_planet,
-               _.completed_trial,
-               _.points
-             )
-          )
+    # to keep this code consistent with my r code, i could set trial_index column equal to actual row number, now that practice trials have been filtered; not a biggie, though
+    kept = all_mutated.loc[completed_per_sub > min_completed,
+                           ["assignment_id", "trial_index", "og_pair", "stake_type", "pair_sides",
+                            "preset_planet", "completed_trial", "points"]]
 
-        # if sub_df['completed_trial'].sum() > 240:  # filter out participants with a lot of no responses
-        if ((sys.argv[2] == 'first_go' and sub_df['completed_trial'].sum() > 240) or (sys.argv[2] == 'second_go' and sub_df['completed_trial'].sum() > 213)):
-            output_path = os.path.join(data_dir, "Spliced", str(sub_id) + ".csv")
-            sub_df.to_csv(output_path)
+    sub_dfs = {str(sub_id) + ".csv": sub_df.drop(columns="assignment_id")
+               for sub_id, sub_df in kept.groupby("assignment_id", sort=False)}
 
+    with ThreadPoolExecutor() as executor:                                      # writing is mostly waiting on the file system, so the writes can overlap
+        list(executor.map(lambda item: item[1].to_csv(os.path.join(data_directory, "Spliced", item[0])),
+                          sub_dfs.items()))
 
-def generate_csv_of_params(func):
-    table_of_params = {}
+    build_trial_store(rocket_pairs, pair_sides, planets, data_directory, sub_dfs)   # the same trials, already encoded, in one file for the fitting jobs to load
 
-    def generating_func(recreate_indv_csvs, iterations, include_priors, **kwargs):
 
-        if recreate_indv_csvs:
-            splice_raw()
+def generate_job_manifest(func):
 
-        func(table_of_params, iterations, include_priors, **kwargs)
-        df = pd.DataFrame(table_of_params)
-        df.to_csv(os.path.join(_thisDir, "..", sys.argv[2], "all_params_for_fitting.csv"))
-    return generating_func
+    def generating_func(recreate_indv_csvs, iterations, include_priors, seed=None, **kwargs):
 
+        if recreate_indv_csvs:
+            splice_raw()
 
-@generate_csv_of_params
-def generate_params(param_dict, iterations, include_priors, **kwargs):
-
-    spliced_dir = os.listdir(os.path.join(data_dir, "Spliced"))
+        experiment_dir = os.path.join(_thisDir, "..", sys.argv[2])
+        manifest_settings, cache_keys = func(iterations, include_priors, **kwargs)
+        write_manifest(os.path.join(experiment_dir, MANIFEST_NAME), seed=seed, **manifest_settings)
 
-    param_dict["sub_path"] = spliced_dir * iterations
+        # rows the fit cache already has don't need a job (see `run_state.py`)
+        state = RunState(os.path.join(experiment_dir, "run_state"),
+                         open_manifest(os.path.join(experiment_dir, MANIFEST_NAME)))
+        state.mark_cached(FitCache(os.path.join(experiment_dir, "fit_cache")), cache_keys)
+    return generating_func
 
-    param_reps = iterations * len(spliced_dir)
 
-    param_dict["include_priors"] = [include_priors] * param_reps
+@generate_job_manifest
+def generate_params(iterations, include_priors, **kwargs):
 
-    for param, bounds in kwargs.items():
+    spliced_dir = sorted(os.listdir(os.path.join(data_dir, "Spliced")))
+    all_bounds = [kwargs[param] for param in PARAM_NAMES]
 
-        param_dict[param + '_0'] = np.random.default_rng().uniform(*bounds, param_reps)
+    # each subject's first start picks up where earlier runs left off, if the
+    # fit cache has an optimum for the same trials; every other start is
+    # random (see `job_manifest.py`)
+    cache = FitCache(os.path.join(_thisDir, "..", sys.argv[2], "fit_cache"))
+    seeded_starts, cache_keys = {}, {}
 
-        param_dict[param + "_lb"] = bounds[0]
-        param_dict[param + "_ub"] = bounds[1]
+    for sub_path in spliced_dir:
+        trials = load_trials(data_directory=data_dir, sub_path=sub_path)
+        cache_keys[sub_path] = (os.path.splitext(sub_path)[0], trial_hash(trials), config_hash(include_priors, all_bounds))
+        cached = cache.seed_start(*cache_keys[sub_path], all_bounds)
+        if cached is not None:
+            seeded_starts[sub_path] = cached
 
-    return param_dict
+    return dict(sub_paths=spliced_dir, iterations=iterations, include_priors=include_priors,
+                bounds=all_bounds, seeded_starts=seeded_starts), cache_keys
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Keeps fits as rows of a parquet dataset, rather than as one pickle per fit.
+
+Every process that saves fits (an array task in `run_wrapper.py`, or the
+parent process in `fit_pool.py`) gets its own `ResultWriter`, which writes its
+rows to part files of its own under `<root>/parts`, so tasks running at the
+same time never write to the same file. A part file only shows up under its
+final name once it has been written in full. Every so often (or once all the
+array tasks are done), `compact` merges whatever part files exist into a
+single file under `<root>/compacted` and deletes those parts.
+
+    python results_store.py compact
+    python results_store.py best
+
+Each row holds the subject, the start (the row of the job manifest the fit
+came from), whether priors were included, the bounds and starting
+values (e.g., `α_lb`, `α_ub`, `α_0`), the fitted values (e.g., `α`), and
+`fun`, `nit`, `nfev`, `status`, `success`, and `trials` from the fit.
+Instrumented fits also get a summary each, in a `.json` file under
+`<root>/instrumentation` with the same name as the part file their rows went
+into.
+"""
+
+from sys import argv
+from os import path, makedirs, replace, remove
+from glob import glob
+from uuid import uuid4
+import json
+from wrapper import PARAM_NAMES
+
+
+class ResultWriter:
+
+    def __init__(self, root, task_id):
+        self.parts_dir = path.join(root, "parts")
+        self.summaries_dir = path.join(root, "instrumentation")
+        self.task_id = task_id
+        self.rows = []
+        self.summaries = {}
+        makedirs(self.parts_dir, exist_ok=True)
+
+    def add(self, index, results):
+        self.rows.append(fit_to_row(index, results))
+        if "instruments" in results:
+            self.summaries[str(index)] = results["instruments"]
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        import pandas as pd                                                    # here rather than up top, so fitting jobs don't load pandas and arrow until they have something to write
+
+        name = f"task-{self.task_id}-{uuid4().hex.upper()[0:10]}"
+        write_atomically(pd.DataFrame(self.rows), path.join(self.parts_dir, name + ".parquet"))
+        self.rows = []
+
+        if self.summaries:                                                      # only there when the fits were instrumented (see `instrument.py`); named after the part file holding the same fits, and keyed by start
+            makedirs(self.summaries_dir, exist_ok=True)
+            with open(path.join(self.summaries_dir, name + ".json"), "w") as file:
+                json.dump(self.summaries, file)
+            self.summaries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+def fit_to_row(index, results):
+
+    # `results` is the dictionary of job params merged with the fit, as built
+    # in `run_wrapper.py` and `fit_pool.py`
+    row = {
+        "subject": path.splitext(results["sub_path"])[0],
+        "start": index,
+        "include_priors": bool(results["include_priors"])
+    }
+
+    for param_index, param in enumerate(PARAM_NAMES):
+        for suffix in ("_lb", "_ub", "_0"):
+            row[param + suffix] = results[param + suffix]
+        row[param] = results["x"][param_index]
+
+    for key in ("fun", "nit", "nfev", "status", "success", "trials"):
+        row[key] = results[key]
+
+    return row
+
+
+def write_atomically(df, filename):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    temporary = filename + ".tmp"                                               # readers only look for files ending in ".parquet", so they never see a half-written part
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), temporary)
+    replace(temporary, filename)
+
+
+def data_files(root):
+    return sorted(glob(path.join(root, "parts", "*.parquet")) +
+                  glob(path.join(root, "compacted", "*.parquet")))
+
+
+def read_fits(root, columns=None):
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    files = data_files(root)
+    if not files:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat([pq.read_table(file, columns=columns).to_pandas() for file in files],
+                     ignore_index=True)
+
+
+def compact(root):
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    parts = sorted(glob(path.join(root, "parts", "*.parquet")))                # only the parts that exist now get merged and deleted; tasks can keep writing new ones in the meantime
+    if not parts:
+        return
+
+    fits = pd.concat([pq.read_table(part).to_pandas() for part in parts], ignore_index=True)   # through pandas rather than arrow, since e.g. `nfev` is an int in some parts and a float (with NaNs for starts that were stopped early) in others
+
+    makedirs(path.join(root, "compacted"), exist_ok=True)
+    write_atomically(fits,
+                     path.join(root, "compacted", f"fits-{uuid4().hex.upper()[0:10]}.parquet"))
+
+    for part in parts:
+        remove(part)
+
+
+def best_fits(root):
+    fits = read_fits(root).dropna(subset=["fun"])
+    return fits.loc[fits.groupby("subject")["fun"].idxmin()].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    from run_wrapper import results_dir
+
+    if argv[1] == "compact":
+        compact(results_dir)
+    elif argv[1] == "best":
+        best_fits(results_dir).to_csv(path.join(results_dir, "best_fits.csv"), index=False)
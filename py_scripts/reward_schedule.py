@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Payoff schedules for simulations, worked out ahead of time.
+
+How much treasure each planet holds on each trial follows a random walk that
+has nothing to do with what the agent does, so rather than stepping every
+planet's walk live inside `Agent` (or `simulate_many`), `reward_schedule`
+works out the treasure for every planet on every trial in one go. Schedules
+are cached by seed and number of trials, so any number of simulated agents can
+share the same reward environment; comparing parameter sets on the same
+schedule takes the luck of the payoffs out of the comparison.
+
+The walk matches `PlanetObj.random_walk`: each step adds a rounded Gaussian
+step and reflects off `rwalk_min` and `rwalk_max`. Reflecting at every step is
+the same (in distribution) as letting the walk wander off unreflected and then
+folding the whole path back into the bounds afterwards, since the steps are
+symmetric; folding lets us compute a whole path with a cumulative sum.
+"""
+
+from functools import lru_cache
+import numpy as np
+from simulate_and_model import PlanetObj
+
+
+@lru_cache(maxsize=32)
+def reward_schedule(seed, trials, n_planets=2):
+
+    # one row per trial, one column per planet; row t is what each planet
+    # pays out on trial t
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(PlanetObj.rwalk_mean, PlanetObj.rwalk_sd, (int(trials), n_planets))
+
+    start = np.round((PlanetObj.rwalk_min + PlanetObj.rwalk_max) / 2 + steps[0])   # `PlanetObj.__init__` takes one step from the middle
+    unfolded = start + np.cumsum(np.round(steps[1:]), axis=0)                  # from there, rounding (treasure + step) is the same as adding the rounded step
+
+    schedule = fold(np.vstack([start, unfolded]))
+    schedule.flags.writeable = False                                            # shared by everyone who asks for this seed, so nobody gets to change it
+
+    return schedule
+
+
+def fold(unfolded):
+    low, high = PlanetObj.rwalk_min, PlanetObj.rwalk_max
+    distance = np.mod(unfolded - low, 2 * (high - low))
+
+    return low + np.where(distance <= high - low, distance, 2 * (high - low) - distance)
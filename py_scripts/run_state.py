@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Keeps track of where every row of the job manifest is at, so that rows whose
+array task got preempted, timed out, or crashed can be found and re-queued on
+their own, picking up from where their fit left off.
+
+    python run_state.py status          # how many rows are done, skipped, cached, running, failed, preempted, or not started
+    python run_state.py unfinished      # every row that's none of done, skipped, or cached, as a Slurm array spec (e.g., "3,7-9,15")
+
+`shcripts/run_all_jobs.sh` runs `unfinished` right after
+`prep_params_for_cluster.py` to submit only the rows the fit cache doesn't
+already have (see `mark_cached`), and `shcripts/resubmit_jobs.sh` runs it to
+re-queue just the rows that didn't finish with `run_one_job.sh`. Since a row
+that's still running counts as unfinished, the latter should only be run once
+the original array is over.
+
+Each row gets a small json file in `run_state` in the experiment's folder,
+written by `run_wrapper.py` as the row's fit goes along: "running" when it
+starts, then a checkpoint of the best parameters and objective so far, and
+the number of iterations, at most every `CHECKPOINT_SECONDS` (through the
+optimizer's callback), and finally "done" once its results have been written,
+or "failed" (or "preempted", when Slurm sent a SIGTERM) with the error. When a
+row that didn't finish gets run again, its fit starts from the last
+checkpoint instead of the row's own start. L-BFGS-B's memory of past steps
+doesn't survive that, so it takes a few iterations to get back up to speed.
+
+Records are named after row numbers, but rerunning `prep_params_for_cluster.py`
+can put a different subject, start, or bounds at the same row. So each record
+also holds its row's identity (see `row_identity` in `job_manifest.py`), and
+one that doesn't match the current manifest counts as never having been
+written: its row doesn't get resumed from it, and shows up as "not started".
+
+`fit_pool.py` marks its rows "done" as well, once each subject's part file is
+written, and a subject's starts that a race made unnecessary (see `StartRace`)
+"skipped", but doesn't checkpoint. It leaves out "cached" rows altogether.
+"""
+
+from sys import argv
+from os import path, makedirs, replace, remove, environ, listdir
+from time import perf_counter, strftime
+from uuid import uuid4
+from platform import node
+import json
+import numpy as np
+from wrapper import PARAM_NAMES
+from fit_cache import fit_before, start_of
+from job_manifest import row_identity, manifest_rows
+
+
+CHECKPOINT_SECONDS = 60                                                         # at most one checkpoint this often, to go easy on the shared file system
+FINISHED = ("done", "skipped", "cached")
+UNFINISHED = ("running", "failed", "preempted", "not started")
+
+
+class Preempted(Exception):
+    pass
+
+
+def raise_preempted(signum, frame):
+    raise Preempted("got SIGTERM (preempted or out of time)")                   # Slurm sends this a little while before killing the task
+
+
+class RunState:
+
+    def __init__(self, root, manifest):
+        self.root = root
+        self.manifest = manifest                                                # the manifest the rows are numbered by, as from `open_manifest`
+        self.records = {}                                                       # the records of the rows this process is working on
+        makedirs(root, exist_ok=True)
+
+    def current(self, record):
+
+        # False for a record left over from an earlier manifest
+        index = record["index"]
+        return index < len(self.manifest) and all(record.get(key) == value
+                                                  for key, value in row_identity(self.manifest, index).items())
+
+    def record_path(self, index):
+        return path.join(self.root, f"{index}.json")
+
+    def lookup(self, index):
+        record_path = self.record_path(index)
+        if not path.exists(record_path):
+            return None
+
+        with open(record_path) as file:
+            record = json.load(file)
+
+        return record if self.current(record) else None
+
+    def status(self, index):
+        return (self.lookup(index) or {}).get("status", "not started")
+
+    def write(self, index, **changes):
+        record = self.records.setdefault(index, {"index": index, **row_identity(self.manifest, index)})
+        record.update(changes, host=node(), job=environ.get("SLURM_ARRAY_JOB_ID"), updated=strftime("%Y-%m-%dT%H:%M:%S"))
+
+        temporary = self.record_path(index) + "." + uuid4().hex.upper()[0:10] + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(record, file)
+        replace(temporary, self.record_path(index))
+
+    def start(self, index):
+
+        # marks the row as running, and hands back its last checkpoint if it
+        # has been run before without finishing (None otherwise)
+        previous = {"index": index, **row_identity(self.manifest, index), "attempts": 0, "x": None, "fun": None, "nit": 0,
+                    **(self.lookup(index) or {})}
+        resumable = previous["x"] is not None and previous.get("status") != "done"
+
+        self.records[index] = previous
+        self.write(index, status="running", attempts=previous["attempts"] + 1, message=None)
+
+        return dict(previous) if resumable else None
+
+    def checkpointer(self, index, every=CHECKPOINT_SECONDS):
+
+        # a callback for `fit_trials` (by way of `model`), which keeps the
+        # best point so far in memory and writes it out every `every` seconds
+        record = self.records[index]
+        last_write = [perf_counter()]
+
+        def callback(xk, fun):
+            record["nit"] += 1
+            if fun is not None and (record["fun"] is None or fun < record["fun"]):
+                record["x"], record["fun"] = np.asarray(xk, dtype=float).tolist(), float(fun)
+
+            if perf_counter() - last_write[0] >= every:
+                self.write(index)
+                last_write[0] = perf_counter()
+
+        return callback
+
+    def finish(self, index, fit):
+        self.records.setdefault(index, {"index": index, **row_identity(self.manifest, index),
+                                        "nit": int(fit["nit"] or 0)})           # rows that weren't started through `start` (i.e., from `fit_pool.py`) go by the fit's own count
+        self.write(index, status="done", x=np.asarray(fit["x"], dtype=float).tolist(), fun=float(fit["fun"]),
+                   message=None)
+
+    def skip(self, index):
+        self.write(index, status="skipped", message="the subject's other starts had already agreed")
+
+    def mark_cached(self, cache, keys):
+
+        # for `prep_params_for_cluster.py`, once it has written a new
+        # manifest: rows whose start the fit cache has already fit (under the
+        # same trials and configuration) get marked "cached", so they don't get
+        # submitted at all. `keys` maps each subject's csv to its key in
+        # `cache`. Any other row's finished record (e.g., from before the
+        # trials changed) gets cleared, so that the row gets fit again
+        entries = {sub_path: cache.lookup(*key) for sub_path, key in keys.items()}
+
+        for index, params in manifest_rows(self.manifest):
+            entry = entries[params["sub_path"]]
+            if entry is not None and fit_before(entry, start_of(params)):
+                self.write(index, status="cached", message="already fit; in the fit cache")
+            elif self.status(index) in FINISHED:
+                remove(self.record_path(index))
+
+    def fail(self, index, error):
+        self.write(index, status="preempted" if isinstance(error, Preempted) else "failed",
+                   message=f"{type(error).__name__}: {error}")
+
+    def statuses(self):
+
+        # every row's status, with "not started" for rows without a record
+        # from the current manifest
+        statuses = np.full(len(self.manifest), "not started", dtype=object)
+        for name in listdir(self.root):
+            if name.endswith(".json"):
+                with open(path.join(self.root, name)) as file:
+                    record = json.load(file)
+                if self.current(record):
+                    statuses[record["index"]] = record["status"]
+
+        return statuses
+
+
+def resume_params(params, checkpoint):
+
+    # the manifest row's params, but starting from the checkpoint
+    if checkpoint is None:
+        return params
+
+    return {**params, **{param + "_0": float(np.clip(value, params[param + "_lb"], params[param + "_ub"]))
+                         for param, value in zip(PARAM_NAMES, checkpoint["x"])}}
+
+
+def array_spec(indices):
+
+    # 0-based rows as 1-based Slurm array task IDs, with runs collapsed
+    # into ranges
+    ranges = []
+    for task_id in np.asarray(indices, dtype=int) + 1:
+        if ranges and task_id == ranges[-1][1] + 1:
+            ranges[-1][1] = task_id
+        else:
+            ranges.append([task_id, task_id])
+
+    return ",".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+if __name__ == '__main__':
+    from run_wrapper import experiment_dir, state_dir
+    from job_manifest import MANIFEST_NAME, open_manifest
+
+    statuses = RunState(state_dir, open_manifest(path.join(experiment_dir, MANIFEST_NAME))).statuses()
+
+    if argv[1] == "status":
+        for status in FINISHED + UNFINISHED:
+            print(f"{status:>12}: {np.sum(statuses == status)}")
+
+    elif argv[1] == "unfinished":
+        print(array_spec(np.flatnonzero(np.isin(statuses, UNFINISHED))))
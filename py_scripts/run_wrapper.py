@@ -3,27 +3,43 @@
 
 from sys import argv
 from os import path, chdir
-import pandas as pd
-from wrapper import model
-from uuid import uuid4
-from pickle import dump
+from signal import signal, SIGTERM
+from results_store import ResultWriter
+from fit_cache import FitCache, cached_fit
+from instrument import instrumented
+from job_manifest import MANIFEST_NAME, open_manifest, job_params
+from run_state import RunState, raise_preempted, resume_params
 
 _thisDir = path.dirname(path.abspath(__file__))
-chdir(_thisDir)
 data_dir = path.join(_thisDir, "..", "..", "Data", "second_go")
+experiment_dir = path.join(_thisDir, "..", "second_go")
+results_dir = path.join(experiment_dir, "fit_results")                         # parquet dataset of fits; see `results_store.py`
+cache_dir = path.join(experiment_dir, "fit_cache")                             # best optimum so far per subject and model configuration; see `fit_cache.py`
+state_dir = path.join(experiment_dir, "run_state")                             # how far along each row is, with checkpoints; see `run_state.py`
+
 
 if __name__ == '__main__':
+    chdir(_thisDir)                                                             # only when run as a job, so importing the folder names from here doesn't move anyone else
 
-    df = pd.read_csv(path.join(_thisDir, "..", "second_go", "all_params_for_fitting.csv")) # reads in the csv of parameters for fitting
+    manifest = open_manifest(path.join(experiment_dir, MANIFEST_NAME))         # memory-mapped, so only this task's row ever gets read
     index = int(argv[1]) - 1
 
-    params = df.iloc[index, :][1:]                                              # these two lines grab a row of the csv based on argv[1]...
-    params = pd.Series.to_dict(params)                                          # ... and then we convert that row to a dictionary (where column names are the keys and cell values are values)
+    params = job_params(manifest, index)                                        # the row as a dictionary (where column names are the keys and cell values are values)
+
+    state = RunState(state_dir, manifest)
+    checkpoint = state.start(index)                                             # where this row's fit got to last time, if it was cut short
+    signal(SIGTERM, raise_preempted)
+
+    try:
+        fit = instrumented(cached_fit, FitCache(cache_dir), data_dir, params,
+                           resumed=resume_params(params, checkpoint), callback=state.checkpointer(index))
+        results = {**params, **fit}                                             # creates a dictionary based on the dictionary of params, and also of the results from fitting the model (which gets fit based on feeding in params as the input, unless that exact fit is already in the cache); the row keeps its original start even when the fit picked up from a checkpoint
 
-    results = {**params, **model(data_directory=data_dir, **params)}            # creates a dictionary based on the dictionary of csv params, and also of the results from fitting the model (which gets fit based on feeding in params as the input)
+        with ResultWriter(results_dir, index) as writer:
+            writer.add(index, results)
 
-    random_characters = uuid4().hex.upper()[0:10]                               # creates a string of random characters to be added to the end of the pickle file to distinguish multiple fits from the same participant
+    except BaseException as error:
+        state.fail(index, error)
+        raise
 
-    filename = path.join(_thisDir, "..", "second_go", "fits", f"fit_{index}_{random_characters}.pickle")
-    with open(filename, "wb") as handle:
-        dump(results, handle)
+    state.finish(index, fit)
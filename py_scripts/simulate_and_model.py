@@ -5,8 +5,8 @@
 Order of things-
 
 First we run mle. We create an `Agent` object, and then update the `Agent`
-trial by trial. Finally we extract from `Agent` an attribute called `p_choice`,
-which is a vector of the negative log likelihoods from each choice.
+trial by trial. Finally we extract from `Agent` an attribute called
+`log_likelihood`, which is the sum of the log likelihoods of each choice.
 
     When we create `Agent`, we in turn — on the line starting with
     `self.generate_objs` — create four objects; one object for each of the two
@@ -30,15 +30,16 @@ which is a vector of the negative log likelihoods from each choice.
 
     After agent is created, we loop through a bunch of trials (this happens on
     the line "for trial in sub_df.itertuples():"). Along the course of a trial,
-    we save 27 trial-relevant variables/parameters to `Agent.log`. In terms of
+    we can save 27 trial-relevant variables/parameters to `Agent.log` (only
+    when we ask for them — see `Agent` below). In terms of
     the sequence of a trial — we use our existing Qmb and Qtd values leftover
     from the previous trial to determine the Q values of each choice option for
     the current trial. Then, we see what participants (or the simulation,
     depending on whether we're running a model or a simluation) chose, and we
     compare that choice with the Q values for that choice to get an estimated
     probability of making that choice according to our model — thus there's
-    one probability value per trial, and that creates a vector of probability
-    values that gets saved at the end and fed to the minimization function.
+    one probability value per trial, and the logs of those probabilities get
+    added up as we go and fed to the minimization function at the end.
 
     Finally, we update the Qtd and Qmb values based on the reward during that
     trial. See below for a description of the `q_update` function.
@@ -122,11 +123,17 @@ other six greek letters will change.
 """
 
 import numpy as np
-from pandas import options
 from random import gauss
-from scipy.stats import gamma, norm, beta
+from math import exp, log, log1p, lgamma, pi
 
-options.display.float_format = '{:.2f}'.format # do I need this?
+STAKE_TYPES = ('high', 'faux_high', 'faux_low', 'low')                         # same order as the four ws at the end of `params`
+
+# the prior on each parameter, in the same order as `params` (α, β, λ, π, ρ,
+# and then the four ws): the family of distribution, followed by its two
+# parameters — shape and scale for "gamma", mean and sd for "normal", and a
+# and b for "beta"
+DEFAULT_PRIORS = (("beta", 2, 2), ("gamma", 3, .2), ("beta", 2, 2), ("normal", 0, 1), ("normal", 0, 1),
+                  ("beta", 2, 2), ("beta", 2, 2), ("beta", 2, 2), ("beta", 2, 2))
 
 class RocketPairObj:
     def __init__(self, pair, planets, π, ρ, ws):
@@ -134,7 +141,7 @@ class RocketPairObj:
         self.planets = planets
         self.π = π
         self.ρ = ρ
-        self.w_dict = dict(zip(('high', 'faux_high', 'faux_low', 'low'), ws))   # we set the four values in this dict equal to the four ws we pass in from the csv of parameters for fitting
+        self.w_dict = dict(zip(STAKE_TYPES, ws))                                # we set the four values in this dict equal to the four ws we pass in from the csv of parameters for fitting
         self.Qtd = {planet: .5 for planet in self.planets}
         self.Qmb = {planet: .5 for planet in self.planets}
         self.Q = {planet: .5 for planet in self.planets}
@@ -159,16 +166,22 @@ class RocketPairObj:
 
 
 class PlanetObj:
-    def __init__(self):
+    rwalk_min = -4
+    rwalk_max = 5
+    rwalk_mean = 0
+    rwalk_sd = 2
+
+    def __init__(self, treasures=None):
         self.Q = .5
-        self.rwalk_min = -4
-        self.rwalk_max = 5
-        self.rwalk_mean = 0
-        self.rwalk_sd = 2
+        self.treasures = treasures                                              # if we're sharing a reward schedule (see `reward_schedule.py`), an iterator over this planet's treasure on each trial
         self.treasure = (self.rwalk_min + self.rwalk_max) / 2
         self.random_walk()
 
     def random_walk(self):
+        if self.treasures is not None:
+            self.treasure = next(self.treasures, None)                          # None once the schedule runs out, which only happens after the last trial
+            return
+
         rwalk_change = gauss(self.rwalk_mean, self.rwalk_sd)
 
         self.treasure = round(self.treasure + rwalk_change)
@@ -183,10 +196,13 @@ class PlanetObj:
 class Agent:
 
     '''
-    It's worth emphasizing that even though in this script the only output of
-    `Agent` that we use is the dictionary values within the key `p_choice`
-    within the `Agent.log` attribute, `Agent.log` stashes a value for each trial
-    for each of 27 variables (keys); those are — `trial_index`, `og_pair`,
+    When we're fitting, the only output of `Agent` that we use is
+    `Agent.log_likelihood`, the running sum of the log of `p_choice` across
+    trials, so by default that's all `Agent` keeps track of. If we pass in
+    `trace_length` (the number of trials we're going to run, as `simulate`
+    does), `Agent.log` is also set up as a structured array with one row per
+    completed trial and a column for each of 27 variables; those are —
+    `trial_index`, `og_pair`,
     `pair_sides`, `stake_type` `Qtd(one,red)`, `Qtd(one,purple)`,
     `Qmb(one,red)`, `Qmb(one,purple)`, `Q(one,red)`, `Q(one,purple)`,
     `Qplus(one,red)`, `Qplus(one,purple)`, `Qtd(two,red)`, `Qtd(two,purple)`,
@@ -195,17 +211,25 @@ class Agent:
     `planet`, `points`, `rpe1`, and `rpe2`
     '''
 
-    def __init__(self, procedure, rocket_pairs, planets, α, β, λ, π, ρ, ws):
+    def __init__(self, procedure, rocket_pairs, planets, α, β, λ, π, ρ, ws, trace_length=None,
+                 reward_schedule=None, binary_choice=True):
         self.planets = planets
         self.rocket_pair_objs = {}
         self.planet_objs = {}
-        self.generate_objs(rocket_pairs, π, ρ, ws)
+        self.generate_objs(rocket_pairs, π, ρ, ws, reward_schedule)
         self.procedure = procedure
         self.α = α
         self.β = β
         self.λ = λ
         self.prev_rocket_pair, self.prev_pair_sides, self.prev_planet, self.planet = [None] * 4
-        self.log = {}
+        self.log_likelihood = 0
+        self.log = None
+
+        if trace_length is not None:
+            self.generate_log(trace_length)
+
+        if binary_choice and len(planets) == 2:
+            self.planet_selection = self.binary_planet_selection                # same choices and likelihood, without the NumPy arrays; any other number of planets goes through the general softmax
 
     def trial(self, trial_index, rocket_pair, stake, pair_sides,
               preset_planet=None, trial_was_completed=True, preset_payoff=None):
@@ -238,6 +262,9 @@ class Agent:
 
             self.q_update(rocket_pair_obj, preset_payoff)
 
+            if self.log is not None:
+                self.n_logged += 1
+
         else:
 
             self.planet = preset_planet
@@ -249,22 +276,48 @@ class Agent:
         # softmax
         qs = rocket_pair_obj.Qplus.values()                                     # something useful is, the way we're setting up qs, the choices in `weighted_choices` correspond in order to the planets in `self.planets`; the reason how — weighted_choices comes from qs, which comes from Qplus in the rocket pair object, and we set up Qplus...
         qs = np.fromiter((Q for Q in qs), float)                                # ... using "for planet in self.planets"; therefore, qs is in the same order as `self.planets`, which comes from having fed in `planets` when we defined that rocket pair object; we also fed `planets` into `Agent` when we created `self.planets`
-        weighted_choices = np.exp(qs * self.β)
+        choice_values = qs * self.β
+        choice_values = choice_values - choice_values.max()                     # doesn't change the softmax, but keeps `np.exp` from overflowing when β and Qplus are big
+        log_choices = choice_values - np.log(np.exp(choice_values).sum())       # log-sum-exp, so a choice whose probability underflows to 0 still gets a finite log probability
 
-        weighted_choices = weighted_choices / weighted_choices.sum()            # at this point, we have assigned a probability to each potential decision, based on their Qplus values and the output of those Qplus values after being inputted into a softmax
+        weighted_choices = np.exp(log_choices)                                  # at this point, we have assigned a probability to each potential decision, based on their Qplus values and the output of those Qplus values after being inputted into a softmax
 
         if self.procedure == "simulate":
             self.planet = np.random.choice(self.planets, p=weighted_choices)    # if we're in simulation mode, we pick a planet based on the weights from `weighted_choices`
         elif self.procedure == "model":
             self.planet = preset_planet                                         # if we're in modeling mode, we 'pick' whatever planet the participant picked during that trial
 
-        p_choice = weighted_choices[self.planets.index(self.planet)]            # whatever planet we've picked, we extract its index within `self.planets` (i.e., the order that planet appears in the list `self.planets`); we then use that index to pull the corresponding weight of choosing that planet from `weighted_choices`
+        choice_index = self.planets.index(self.planet)                          # whatever planet we've picked, we extract its index within `self.planets` (i.e., the order that planet appears in the list `self.planets`); we then use that index to pull the corresponding weight of choosing that planet from `weighted_choices`
+        p_choice = weighted_choices[choice_index]
+
+        self.log_likelihood += log_choices[choice_index]
 
         self.log_var(
             ("p_choice", p_choice),
             ("planet", self.planet)
         )
 
+    def binary_planet_selection(self, rocket_pair_obj, preset_planet):
+
+        # `planet_selection` for exactly two planets: a softmax over two
+        # options is a logistic of the difference between them, so everything
+        # here stays as plain floats
+        first, second = self.planets
+        margin = self.β * (rocket_pair_obj.Qplus[first] - rocket_pair_obj.Qplus[second])   # log odds of picking the first planet
+
+        if self.procedure == "simulate":
+            self.planet = first if np.random.random_sample() < exp(log_logistic(margin)) else second   # the same draw `np.random.choice` makes, so seeded simulations pick the same planets either way
+        elif self.procedure == "model":
+            self.planet = preset_planet
+
+        log_p_choice = log_logistic(margin if self.planet == first else -margin)
+        self.log_likelihood += log_p_choice
+
+        self.log_var(
+            ("p_choice", exp(log_p_choice)),
+            ("planet", self.planet)
+        )
+
     # note that this update occurs after we've chosen a planet
     # we update after after the choice, but we don't use those values
     # until choice on next trial; update results in starting
@@ -306,69 +359,119 @@ class Agent:
             setattr(self, param[0], param[1])
 
     def log_var(self, *args):
-        for arg in args:
-            key, val = arg
-            if key not in self.log.keys():
-                self.log[key] = [val]
-            else:
-                self.log[key].append(val)
+        if self.log is None:
+            return
+
+        for key, val in args:
+            self.log[key][self.n_logged] = val
 
-    def generate_objs(self, rocket_pairs, π, ρ, ws):
+    def generate_objs(self, rocket_pairs, π, ρ, ws, reward_schedule):
 
         for pair in rocket_pairs:
             self.rocket_pair_objs[pair] = RocketPairObj(pair, self.planets, π, ρ, ws)
 
-        for planet in self.planets:
-            self.planet_objs[planet] = PlanetObj()
+        for index, planet in enumerate(self.planets):
+            treasures = None if reward_schedule is None else iter(reward_schedule[:, index].tolist())
+            self.planet_objs[planet] = PlanetObj(treasures)
 
     def log_qs(self):
+        if self.log is None:
+            return
+
+        for key, q_dict, planet_name in self.q_columns:
+            self.log[key][self.n_logged] = q_dict[planet_name]
+
+        for planet_name, planet_obj in self.planet_objs.items():
+            self.log['Q(' + planet_name + ')'][self.n_logged] = planet_obj.Q
+
+    def generate_log(self, trace_length):
+
+        # work out the column names for the Q values once, along with which
+        # dictionary each column reads from, rather than rebuilding the names
+        # every trial
+        self.q_columns = []
         for rocket_pair_name, rocket_pair_obj in self.rocket_pair_objs.items():
             for q_type in ("Qtd", "Qmb", "Q", "Qplus"):
-                for planet_name, q_for_planet in getattr(rocket_pair_obj, q_type).items():
-
+                for planet_name in self.planets:
                     key = q_type + '(' + rocket_pair_name + ',' + planet_name + ')'
+                    self.q_columns.append((key, getattr(rocket_pair_obj, q_type), planet_name))
 
-                    if key not in self.log.keys():
-                        self.log[key] = [q_for_planet]
-                    else:
-                        self.log[key].append(q_for_planet)
+        columns = ([("trial_index", int), ("og_pair", object), ("pair_sides", object), ("stake_type", object)] +
+                   [(key, float) for key, _, _ in self.q_columns] +
+                   [('Q(' + planet_name + ')', float) for planet_name in self.planets] +
+                   [("p_choice", float), ("planet", object), ("points", float), ("rpe1", float), ("rpe2", float)])
 
-        for planet_name, planet_obj in self.planet_objs.items():
+        self.log = np.zeros(trace_length, dtype=columns)                         # preallocated; `self.n_logged` is how many rows have been filled in so far
+        self.n_logged = 0
 
-            key = 'Q(' + planet_name + ')'
 
-            if key not in self.log.keys():
-                self.log[key] = [planet_obj.Q]
-            else:
-                self.log[key].append(planet_obj.Q)
+def log_logistic(x):
+    return -(max(-x, 0) + log1p(exp(-abs(x))))                                  # log(1 / (1 + exp(-x))), without overflowing for big |x|
 
 
-def mle(params, rocket_pairs, planets, sub_df, include_priors):
-    print(*params[0:5])
-    print(params[5:])
+def mle(params, rocket_pairs, planets, sub_df, include_priors, instruments=None):
     agent = Agent("model", rocket_pairs, planets, *params[0:5], params[5:])     # the star in front of `params[0:5]` means we treat each value within `params[0:5]` as independent from one another, as opposed to within a list. They correspond to α, β, λ, π, ρ. Meanwhile, `params[5:]` corresponds to the four starting ws for each of the four stake groups (high, faux_high, faux_low, and low), repsectively.
 
+    if instruments is not None:
+        instruments.instrument_agent(agent)                                     # times each phase of every trial; see `instrument.py`
+
     for trial in sub_df.itertuples():
         agent.trial(trial.trial_index, trial.og_pair, trial.stake_type, trial.pair_sides,
                     trial.preset_planet, trial.completed_trial, trial.points)
 
-    probs = agent.log['p_choice']
+    aposteriori = -agent.log_likelihood
 
     if include_priors:
+        aposteriori -= np.sum(log_prior_densities(params))
+
+    return aposteriori
+
+
+def log_prior_densities(params, priors=None):
+
+    # the same log densities as scipy's `logpdf`s (-inf outside each family's
+    # support), written out so that fitting doesn't have to import scipy.stats
+    log_densities = []
+
+    for param, (family, a, b) in zip(params, priors or DEFAULT_PRIORS):
+        param = np.asarray(param, dtype=float)
 
-        for index, param in enumerate(params):
-            if index == 1:
-                prior_prob = gamma.pdf(param, 3, scale=.2)
+        with np.errstate(divide="ignore", invalid="ignore"):                    # logs of values outside the support, which get swapped for -inf anyway
+            if family == "gamma":
+                log_density = np.where(param >= 0, xlogy(a - 1, param) - param / b - lgamma(a) - a * log(b), -np.inf)
 
-            elif index in {3, 4}:
-                prior_prob = norm.pdf(param, 0, 1)
+            elif family == "normal":
+                log_density = -((param - a) / b) ** 2 / 2 - log(b) - log(2 * pi) / 2
 
             else:
-                prior_prob = beta.pdf(param, 2, 2)
+                log_density = np.where((param >= 0) & (param <= 1),
+                                       xlogy(a - 1, param) + xlogy(b - 1, 1 - param)
+                                       - lgamma(a) - lgamma(b) + lgamma(a + b), -np.inf)
 
-            probs.append(prior_prob)
+        log_densities.append(log_density)
 
-    aposteriori = -np.log(probs).sum()
-    print("----------------")
-    print(agent.log)
-    return aposteriori
+    return log_densities
+
+
+def xlogy(x, y):
+    return x * np.log(y) if x != 0 else np.zeros_like(y)                       # 0 rather than NaN at y = 0 when x is 0, e.g., a beta(1, b) prior at 0
+
+
+def prior_gradient(params, priors=None):
+
+    # derivative of each log density in `log_prior_densities`
+    slopes = []
+
+    for param, (family, a, b) in zip(params, priors or DEFAULT_PRIORS):
+        if family == "gamma":
+            slope = (a - 1) / param - 1 / b                                     # shape a, scale b
+
+        elif family == "normal":
+            slope = -(param - a) / b ** 2                                       # mean a, standard deviation b
+
+        else:
+            slope = (a - 1) / param - (b - 1) / (1 - param)
+
+        slopes.append(slope)
+
+    return slopes
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packs every subject's spliced trials into one `.npz` file, already encoded as
+integer arrays (see `encode_trials` in `likelihood.py`), so a fit doesn't have
+to re-read and re-parse the subject's csv.
+
+`build_trial_store` gets run at the end of `splice_raw` in
+`prep_params_for_cluster.py`, right after the spliced csvs are (re)written.
+The file holds each of the six trial arrays for all subjects laid end to end,
+plus `subjects` (the names of the spliced csvs, which is how the params table
+refers to subjects) and `offsets` (where each subject's trials start and
+stop), so pulling out a subject's trials is just a slice.
+"""
+
+from os import path, listdir
+from functools import lru_cache
+import numpy as np
+from likelihood import encode_trials, assemble_trials
+
+
+STORE_NAME = "trials.npz"
+ARRAYS = ("pair", "stake", "side", "planet", "payoff", "completed")
+
+
+def build_trial_store(rocket_pairs, pair_sides, planets, data_directory, sub_dfs=None):
+
+    # `sub_dfs` maps names of spliced csvs to their data frames, if we already
+    # have them in memory; otherwise we read the csvs back in
+    if sub_dfs is None:
+        from pandas import read_csv
+        sub_dfs = {sub_path: read_csv(path.join(data_directory, "Spliced", sub_path))
+                   for sub_path in listdir(path.join(data_directory, "Spliced"))}
+
+    subjects = sorted(sub_dfs)
+    encoded = [encode_trials(sub_dfs[sub_path], rocket_pairs, pair_sides, planets)
+               for sub_path in subjects]
+
+    lengths = [len(sub_arrays[0]) for sub_arrays in encoded]
+
+    np.savez(
+        path.join(data_directory, STORE_NAME),
+        subjects=np.array(subjects),
+        offsets=np.cumsum([0] + lengths),
+        shape=np.array([len(rocket_pairs), len(planets)]),
+        **{name: np.concatenate([sub_arrays[index] for sub_arrays in encoded])
+           for index, name in enumerate(ARRAYS)}
+    )
+
+
+class TrialStore:
+
+    def __init__(self, store_path):
+        with np.load(store_path) as npz:
+            self.arrays = {name: npz[name] for name in ARRAYS}
+            self.offsets = npz["offsets"]
+            self.n_pairs, self.n_planets = npz["shape"].tolist()
+            self.rows = {sub_path: row for row, sub_path in enumerate(npz["subjects"].tolist())}
+
+    def __contains__(self, sub_path):
+        return sub_path in self.rows
+
+    def trials(self, sub_path):
+        row = self.rows[sub_path]
+        start, stop = self.offsets[row], self.offsets[row + 1]
+
+        return assemble_trials(*(self.arrays[name][start:stop] for name in ARRAYS),
+                               self.n_pairs, self.n_planets)
+
+
+@lru_cache(maxsize=None)
+def open_store(data_directory):
+
+    # one copy per process; None if the store hasn't been built
+    store_path = path.join(data_directory, STORE_NAME)
+    return TrialStore(store_path) if path.exists(store_path) else None
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# pandas and scipy.optimize only get imported by the functions that use them,
+# so a fitting job can start up on NumPy alone (see `startup_benchmark` in
+# `benchmark.py`)
 from os import path
 import numpy as np
-from pandas import read_csv, DataFrame
 from random import choice
-from scipy.optimize import minimize
-from simulate_and_model import Agent, mle
+from collections import OrderedDict
+from time import perf_counter
+from simulate_and_model import Agent
+from trial_store import open_store
+from reward_schedule import reward_schedule
+from likelihood import CompiledTrials, compile_trials, neg_log_posterior, batch_neg_log_posterior
+
+
+PARAM_NAMES = ("α", "β", "λ", "π", "ρ", "w_high", "w_faux_high", "w_faux_low", "w_low")   # same order as `params` in `mle`
 
 
 def extract_key_variables(func):
@@ -22,19 +31,27 @@ def extract_key_variables(func):
 
 
 @extract_key_variables
-def simulate(rocket_pairs, pair_sides, planets, α, β, λ, π, ρ, w_high, w_faux_high, w_faux_low, w_low, trials):
+def simulate(rocket_pairs, pair_sides, planets, α, β, λ, π, ρ, w_high, w_faux_high, w_faux_low, w_low, trials,
+             reward_seed=None):
+
+    # with a `reward_seed`, the planets pay out according to the shared
+    # schedule for that seed instead of a fresh random walk
+    schedule = None if reward_seed is None else reward_schedule(reward_seed, int(trials), len(planets))
 
-    agent = Agent("simulate", rocket_pairs, planets, α, β, λ, π, ρ, (w_high, w_faux_high, w_faux_low, w_low))
+    agent = Agent("simulate", rocket_pairs, planets, α, β, λ, π, ρ, (w_high, w_faux_high, w_faux_low, w_low),
+                  trace_length=int(trials), reward_schedule=schedule)
 
     for trial in range(int(trials)):
         og_pair = choice(rocket_pairs)
         stake = "high" if og_pair == rocket_pairs[0] else "low"
         stake = stake if np.random.uniform() <= 2/3 else "faux_" + stake
 
-        pair_sides = choice(pair_sides)
-        agent.trial(trial, og_pair, stake, pair_sides)
+        side = choice(pair_sides)                                               # a fresh name, so the list of sides is still there to choose from next trial
+        agent.trial(trial, og_pair, stake, side)
 
-    pandas_df = DataFrame(agent.log, columns=tuple(agent.log.keys()))
+    from pandas import DataFrame
+
+    pandas_df = DataFrame(agent.log[:agent.n_logged])
     return pandas_df
 
 
@@ -45,30 +62,124 @@ def model(rocket_pairs, pair_sides, planets, data_directory, sub_path, include_p
           w_high_0, w_high_lb, w_high_ub,
           w_faux_high_0, w_faux_high_lb, w_faux_high_ub,
           w_faux_low_0, w_faux_low_lb, w_faux_low_ub,
-          w_low_0, w_low_lb, w_low_ub):
+          w_low_0, w_low_lb, w_low_ub, analytic_gradient=True, callback=None, priors=None,
+          instruments=None):
 
-    if type(sub_path) == str:
-        sub_df = read_csv(path.join(data_directory, "Spliced", sub_path))
-    else:
-        sub_df = sub_path
+    trials = load_trials(data_directory=data_directory, sub_path=sub_path)     # string columns -> integer arrays, once per fit rather than once per likelihood
 
-    fit = minimize(
-        mle,
+    fit = fit_trials(
+        trials,
         np.array([α_0, β_0, λ_0, π_0, ρ_0, w_high_0,
                   w_faux_high_0, w_faux_low_0, w_low_0]),
-        args=(rocket_pairs, planets, sub_df, include_priors),
-        method='L-BFGS-B',
-        bounds=((α_lb, α_ub), (β_lb, β_ub), (λ_lb, λ_ub),
-                (π_lb, π_ub), (ρ_lb, ρ_ub),
-                (w_high_lb, w_high_ub),
-                (w_faux_high_lb, w_faux_high_ub),
-                (w_faux_low_lb, w_faux_low_ub),
-                (w_low_lb, w_low_ub))
+        ((α_lb, α_ub), (β_lb, β_ub), (λ_lb, λ_ub),
+         (π_lb, π_ub), (ρ_lb, ρ_ub),
+         (w_high_lb, w_high_ub),
+         (w_faux_high_lb, w_faux_high_ub),
+         (w_faux_low_lb, w_faux_low_ub),
+         (w_low_lb, w_low_ub)),
+        include_priors, analytic_gradient, callback, priors, instruments
     )
 
-    if type(sub_path) != str:
-        fit = [list(fit.keys()), fit, sub_df['completed_trial'].sum()]
+    if not isinstance(sub_path, (str, CompiledTrials)):                         # a data frame, checked without importing pandas
+        fit = [list(fit.keys()), fit, len(trials.pair)]
     else:
-        fit['trials'] = sub_df['completed_trial'].sum()
+        fit['trials'] = len(trials.pair)                                        # only completed trials make it into `trials`
 
     return fit
+
+
+def fit_trials(trials, x0, bounds, include_priors, analytic_gradient=True, callback=None, priors=None,
+               instruments=None):
+
+    from scipy.optimize import minimize
+
+    objective, on_iteration = neg_log_posterior, None
+
+    if instruments is not None:
+        objective, callback = instruments.watch(objective, callback)            # see `instrument.py`
+
+    # `callback`, if we pass one, gets called after every iteration of the
+    # optimizer with the current parameters and the objective there
+    if callback is not None:
+        objective = RecentEvaluations(objective)
+        on_iteration = lambda xk: callback(xk, objective.lookup(xk))
+
+    start = perf_counter()
+
+    try:
+        fit = minimize(
+            objective,
+            x0,
+            args=(trials, include_priors, analytic_gradient, priors),
+            jac=analytic_gradient,                                              # when True, `neg_log_posterior` hands back the gradient along with the objective, so scipy doesn't need to replay the trials once per parameter to estimate it
+            method='L-BFGS-B',
+            bounds=bounds,
+            callback=on_iteration
+        )
+    except Exception:
+        if instruments is not None:
+            instruments.record_fit(None, perf_counter() - start)               # e.g., a callback stopping the fit early
+        raise
+
+    if instruments is not None:
+        instruments.record_fit(fit, perf_counter() - start)
+
+    return fit
+
+
+class RecentEvaluations:
+
+    # wraps the objective and remembers the last few values it returned, so
+    # that a callback can be handed the objective at each iterate without
+    # replaying the trials again (L-BFGS-B's iterates are always points its
+    # line search has just evaluated)
+    def __init__(self, objective, size=20):
+        self.objective = objective
+        self.size = size
+        self.recent = OrderedDict()
+
+    def __call__(self, x, *args):
+        result = self.objective(x, *args)
+
+        self.recent[x.tobytes()] = result[0] if type(result) == tuple else result
+        if len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+        return result
+
+    def lookup(self, x):
+        return self.recent.get(np.asarray(x, dtype=float).tobytes())
+
+
+@extract_key_variables
+def score(rocket_pairs, pair_sides, planets, data_directory, sub_path, include_priors, param_sets):
+
+    # negative log posterior for every row of `param_sets` (one row per
+    # parameter vector, columns α, β, λ, π, ρ, w_high, w_faux_high, w_faux_low,
+    # w_low), all from a single pass through the subject's trials
+    trials = load_trials(data_directory=data_directory, sub_path=sub_path)
+
+    return batch_neg_log_posterior(param_sets, trials, include_priors)
+
+
+@extract_key_variables
+def load_trials(rocket_pairs, pair_sides, planets, data_directory, sub_path):
+
+    # `sub_path` can be the name of a spliced csv (read from `trial_store.py`'s
+    # file when there is one), a data frame in the same format, or trials that
+    # have already been compiled (e.g., by a worker in
+    # `fit_pool.py` that fits several starts for the same subject)
+    if isinstance(sub_path, CompiledTrials):
+        return sub_path
+
+    store = open_store(data_directory) if type(sub_path) == str else None      # the packed copy of the spliced csvs, if `prep_params_for_cluster.py` has built one
+    if store is not None and sub_path in store:
+        return store.trials(sub_path)
+
+    if type(sub_path) == str:
+        from pandas import read_csv
+        sub_df = read_csv(path.join(data_directory, "Spliced", sub_path))
+    else:
+        sub_df = sub_path
+
+    return compile_trials(sub_df, rocket_pairs, pair_sides, planets)
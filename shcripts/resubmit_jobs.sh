@@ -0,0 +1,10 @@
+#!/bin/bash
+
+#SBATCH --cpus-per-task 1
+
+# re-queues only the rows of the manifest that didn't finish (see py_scripts/run_state.py); they pick up from their last checkpoint. run once the original array is over
+ROWS=$(python ../py_scripts/run_state.py unfinished)
+
+if [ -n "$ROWS" ]; then
+  sbatch --array="$ROWS" run_one_job.sh
+fi
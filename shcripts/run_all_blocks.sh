@@ -0,0 +1,15 @@
+#!/bin/bash
+
+#SBATCH --cpus-per-task 1
+
+ITERATIONS=10
+EXPERIMENT="second_go"
+CPUS_PER_TASK=8
+ROWS_PER_TASK=$(($ITERATIONS * $CPUS_PER_TASK))  # one subject per worker, since each subject's starts all go to the same one
+AGREE_NEEDED=3
+python ../py_scripts/prep_params_for_cluster.py "$ITERATIONS" "$EXPERIMENT"
+
+NUM_SUBS=$(ls ../../Data/second_go/Spliced | wc -l)
+NUM_RUNS=$(($ITERATIONS * $NUM_SUBS))
+NUM_TASKS=$((($NUM_RUNS + $ROWS_PER_TASK - 1) / $ROWS_PER_TASK))
+sbatch --cpus-per-task="$CPUS_PER_TASK" --array=1-"$NUM_TASKS" run_one_block.sh "$ROWS_PER_TASK" "$AGREE_NEEDED"
@@ -6,6 +6,9 @@ ITERATIONS=10
 EXPERIMENT="second_go"
 python ../py_scripts/prep_params_for_cluster.py "$ITERATIONS" "$EXPERIMENT"
 
-NUM_SUBS=$(ls ../../Data/second_go/Spliced | wc -l)
-NUM_RUNS=$(($ITERATIONS * $NUM_SUBS))
-sbatch --array=1-"$NUM_RUNS" run_one_job.sh
\ No newline at end of file
+# only the rows the fit cache doesn't already have (see py_scripts/run_state.py); on unchanged data and settings that's none
+ROWS=$(python ../py_scripts/run_state.py unfinished)
+
+if [ -n "$ROWS" ]; then
+  sbatch --array="$ROWS" run_one_job.sh
+fi
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+#SBATCH --cpus-per-task 8
+
+python ../py_scripts/fit_pool.py "$SLURM_ARRAY_TASK_ID" "$1" "$SLURM_CPUS_PER_TASK" $2
@@ -0,0 +1,28 @@
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "py_scripts"))
+
+import pytest
+from benchmark import SETTINGS, BOUNDS, START, synthetic_subject
+from wrapper import load_trials
+
+
+@pytest.fixture(scope="session")
+def sub_df():
+    return synthetic_subject(SETTINGS["typical"], 200)                          # seeded, with a few unfinished trials
+
+
+@pytest.fixture(scope="session")
+def trials(sub_df):
+    return load_trials(data_directory=None, sub_path=sub_df)
+
+
+@pytest.fixture(scope="session")
+def bounds():
+    return BOUNDS
+
+
+@pytest.fixture(scope="session")
+def start():
+    return START
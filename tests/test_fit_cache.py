@@ -0,0 +1,39 @@
+from os import path
+import numpy as np
+from fit_cache import FitCache, cached_fit, trial_hash, config_hash
+from wrapper import PARAM_NAMES
+from job_manifest import write_manifest, open_manifest, manifest_rows
+from run_state import RunState
+
+
+def test_rerunning_prep_skips_every_start(tmp_path, trials, bounds):
+    manifest_path = path.join(tmp_path, "jobs.npy")
+    cache = FitCache(path.join(tmp_path, "fit_cache"))
+
+    def fit_manifest(seeded_starts=None):
+        write_manifest(manifest_path, ["sub.csv"], 3, True, bounds, seeded_starts=seeded_starts)
+        return [cached_fit(cache, None, params, trials) for _, params in manifest_rows(open_manifest(manifest_path))]
+
+    first = fit_manifest()
+    seeded = cache.seed_start("sub", trial_hash(trials), config_hash(True, bounds), bounds)
+    second = fit_manifest({"sub.csv": seeded})                                  # what `generate_params` does on the next run
+
+    assert all(fit.nfev > 0 for fit in first)
+    assert all(fit.nfev == 0 for fit in second)
+    assert np.isclose(min(fit.fun for fit in second), min(fit.fun for fit in first))
+
+    state = RunState(path.join(tmp_path, "run_state"), open_manifest(manifest_path))
+    state.mark_cached(cache, {"sub.csv": ("sub", trial_hash(trials), config_hash(True, bounds))})
+    assert list(state.statuses()) == ["cached"] * 3                             # so none of them get submitted
+
+
+def test_resumed_fit_counts_as_the_rows_start(tmp_path, trials, bounds):
+    manifest_path = path.join(tmp_path, "jobs.npy")
+    cache = FitCache(path.join(tmp_path, "fit_cache"))
+    write_manifest(manifest_path, ["sub.csv"], 1, True, bounds)
+    (_, params), = manifest_rows(open_manifest(manifest_path))
+
+    checkpoint = {**params, **{param + "_0": (lb + ub) / 2 for param, (lb, ub) in zip(PARAM_NAMES, bounds)}}
+    cached_fit(cache, None, params, trials, resumed=checkpoint)                 # e.g., a preempted row picking up where it left off
+
+    assert cached_fit(cache, None, params, trials).nfev == 0
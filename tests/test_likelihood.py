@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from simulate_and_model import mle
+from likelihood import neg_log_posterior, batch_neg_log_posterior
+from instrument import Instruments
+
+POINTS = (
+    (.5, 3, .6, .2, -.1, .7, .4, .3, .2),
+    (.01, .1, 0, -1, -1, 0, 0, 0, 0),                                          # on or near the bounds
+    (.99, 20, 1, 1, 1, 1, 1, 1, 1),
+    (.3, 15, .9, .8, -.8, .05, .95, .5, .5)
+)
+
+
+@pytest.mark.parametrize("params", POINTS)
+@pytest.mark.parametrize("include_priors", (False, True))
+def test_engine_matches_mle(sub_df, trials, params, include_priors):
+    params = np.array(params, dtype=float)
+    expected = mle(params, ["one", "two"], ["red", "purple"], sub_df, include_priors)
+
+    assert neg_log_posterior(params, trials, include_priors) == pytest.approx(expected, rel=1e-12, abs=1e-10)
+    assert batch_neg_log_posterior(np.vstack([params, params]), trials, include_priors) == \
+        pytest.approx([expected] * 2, rel=1e-12, abs=1e-10)                    # more than one agent goes through the array path instead
+
+
+@pytest.mark.parametrize("params", POINTS[0:1] + POINTS[3:])
+def test_gradient_matches_finite_differences(trials, params, step=1e-6):
+    params = np.array(params, dtype=float)
+    _, grad = neg_log_posterior(params, trials, True, True)
+
+    differences = []
+    for index in range(len(params)):
+        offset = np.zeros(len(params))
+        offset[index] = step
+        differences.append((neg_log_posterior(params + offset, trials, True) -
+                            neg_log_posterior(params - offset, trials, True)) / (2 * step))
+
+    assert grad == pytest.approx(differences, rel=1e-5, abs=1e-5)
+    assert batch_neg_log_posterior(params[None, :], trials, True, True)[1][0] == pytest.approx(grad, abs=1e-12)
+
+
+def test_timed_replay_matches_untimed(trials):
+    params = np.array(POINTS[0], dtype=float)
+    fun, grad = neg_log_posterior(params, trials, True, True)
+
+    with Instruments() as instruments:
+        timed_fun, timed_grad = neg_log_posterior(params, trials, True, True)
+
+    assert timed_fun == fun
+    assert np.array_equal(timed_grad, grad)
+    assert {name: calls for name, (calls, _) in instruments.phases.items() if name != "priors"} == \
+        dict.fromkeys(("q_integrate", "planet_selection", "gradient", "q_update"), len(trials.pair))
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from model_specs import SPECS, fit_spec, fit_family, likelihood_ratio_tests
+
+
+@pytest.mark.parametrize("spec", SPECS, ids=[spec.name for spec in SPECS])
+def test_every_spec_fits_with_priors(trials, bounds, start, spec):
+    fit = fit_spec(trials, spec, bounds, True, spec.project(np.array(start), bounds))
+
+    assert np.isfinite(fit.fun)
+    assert np.all(np.isfinite(fit.jac))
+    assert fit.success
+
+
+def test_nested_models_never_fit_better(trials, bounds, start):
+    fits = fit_family(trials, bounds, start)
+    tests = likelihood_ratio_tests(fits)
+
+    assert np.all(np.isfinite(fits.log_lik))
+    assert np.all(tests.statistic > -1e-3)
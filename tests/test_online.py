@@ -0,0 +1,33 @@
+import pytest
+from wrapper import load_trials, fit_trials
+from likelihood import neg_log_posterior
+from online import start_online
+
+
+@pytest.fixture(scope="module")
+def halves(sub_df, bounds, start):
+
+    # the first half of the trials, fit and folded in, with the second half pushed
+    half = len(sub_df) // 2
+    first_fit = fit_trials(load_trials(data_directory=None, sub_path=sub_df.iloc[:half]), start, bounds, True)
+
+    online = start_online(x=first_fit.x, bounds=bounds, sub_df=sub_df.iloc[:half])
+    online.push(sub_df.iloc[half:])
+    return online, first_fit.x
+
+
+def test_online_matches_full_objective_at_anchor(halves, trials):
+    online, x = halves
+    fun, grad = online.neg_log_posterior(x)
+    full_fun, full_grad = neg_log_posterior(x, trials, True, True)
+
+    assert fun == pytest.approx(full_fun, rel=1e-12)
+    assert grad == pytest.approx(full_grad, abs=1e-10)
+
+
+def test_online_refit_lands_near_full_fit(halves, trials, bounds, start):
+    online, _ = halves
+    full = fit_trials(trials, start, bounds, True)
+    refit = online.refit()
+
+    assert neg_log_posterior(refit.x, trials, True) - full.fun < .05             # the quadratic for the folded-in trials is only second order away from where it was taken
@@ -0,0 +1,28 @@
+from os import path
+from fit_cache import bounds_of
+from job_manifest import write_manifest, open_manifest, job_params
+from run_state import RunState, Preempted
+
+
+def test_new_manifest_ignores_old_records(tmp_path, bounds):
+    manifest_path = path.join(tmp_path, "jobs.npy")
+    state_dir = path.join(tmp_path, "run_state")
+
+    write_manifest(manifest_path, ["aaa.csv"], 2, True, bounds, seed=1)
+    state = RunState(state_dir, open_manifest(manifest_path))
+    state.start(0)
+    state.checkpointer(0, every=0)([.5, 19, .5, 0, 0, .5, .5, .5, .5], 10.)
+    state.fail(0, Preempted())
+    state.finish(1, {"x": [.5] * 9, "fun": 10., "nit": 3})
+
+    state = RunState(state_dir, open_manifest(manifest_path))
+    assert list(state.statuses()) == ["preempted", "done"]
+    assert state.start(0)["x"][1] == 19
+
+    narrower = [(lb, min(ub, 10)) for lb, ub in bounds]
+    write_manifest(manifest_path, ["zzz.csv"], 2, True, narrower, seed=1)      # a different subject and bounds at the same rows
+    state = RunState(state_dir, open_manifest(manifest_path))
+
+    assert list(state.statuses()) == ["not started", "not started"]
+    assert state.start(0) is None                                               # nothing to resume from
+    assert bounds_of(job_params(state.manifest, 0)) == narrower
@@ -0,0 +1,30 @@
+import random
+import numpy as np
+from wrapper import PARAM_NAMES, simulate
+from bulk_simulate import simulate_many
+
+
+PARAMS = (.5, 3, .6, .8, -.6, .7, .4, .3, .2)                                   # big π and ρ, so the side and stay bonuses matter
+AGENTS, TRIALS = 100, 200
+
+
+def summaries(log):
+    stays = (log.planet.to_numpy()[1:] == log.planet.to_numpy()[:-1]).mean()
+    side_a = (log.pair_sides == "a").mean()
+    return stays, side_a
+
+
+def test_simulate_many_matches_simulate():
+    random.seed(0)
+    np.random.seed(0)
+    one_at_a_time = np.array([summaries(simulate(**dict(zip(PARAM_NAMES, PARAMS)), trials=TRIALS))
+                              for _ in range(AGENTS)])
+
+    many = simulate_many(param_sets=np.tile(PARAMS, (AGENTS, 1)), trials=TRIALS, seed=0)
+    all_at_once = np.array([summaries(agent_log) for _, agent_log in many.groupby("agent")])
+
+    difference = one_at_a_time.mean(axis=0) - all_at_once.mean(axis=0)
+    standard_error = np.sqrt(one_at_a_time.var(axis=0) / AGENTS + all_at_once.var(axis=0) / AGENTS)
+
+    assert np.all(np.abs(difference) < 4 * standard_error)
+    assert np.all(np.abs(one_at_a_time[:, 1] - .5) < .2)                         # every agent sees both sides